@@ -0,0 +1,195 @@
+#!usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio, io, os, weakref
+from concurrent.futures import ProcessPoolExecutor
+
+from .screenshot_maker import figure_generator
+from .utils import get_thread_budget, set_thread_budget
+
+
+def _render_figure(kwargs, image_format):
+    """
+    Render a figure in a worker process and return the encoded bytes.
+
+    Args:
+        kwargs (dict): The keyword arguments for :func:`figure_generator`.
+        image_format (str): The image format to encode.
+
+    Returns:
+        bytes: The encoded figure.
+    """
+    buffer = io.BytesIO()
+    figure_generator(output=buffer, image_format=image_format, **kwargs)
+    return buffer.getvalue()
+
+
+def _write_output(output, image_bytes):
+    """
+    Write an encoded figure to a file.
+
+    Args:
+        output (str): The output file name.
+        image_bytes (bytes): The encoded figure.
+    """
+    with open(output, "wb") as output_file:
+        output_file.write(image_bytes)
+
+
+class AsyncFigureGenerator:
+    def __init__(
+        self, max_workers: int = None, max_concurrency: int = None, threads: int = None
+    ):
+        """
+        Asynchronous interface to :func:`figure_generator` for use inside event loops (e.g., web services).
+
+        All loading, preprocessing and rendering happens in a bounded process pool so that the event loop is never blocked and matplotlib state is never shared between requests.
+
+        Args:
+            max_workers (int, optional): The maximum number of worker processes. Defaults to the number of CPUs.
+            max_concurrency (int, optional): The maximum number of figures in flight per event loop; further requests wait for a free slot. Defaults to max_workers.
+            threads (int, optional): The number of threads all worker processes may use in total, split evenly across them. Defaults to None, which uses the FIGURE_GENERATOR_NUM_THREADS environment variable, falling back to the number of CPUs.
+        """
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        self.max_workers = max(1, self.max_workers or 1)
+        self.max_concurrency = (
+            max_concurrency if max_concurrency is not None else self.max_workers
+        )
+        assert self.max_concurrency > 0, "max_concurrency should be positive."
+        self.threads = get_thread_budget(threads) or os.cpu_count() or 1
+        self._executor = None
+        # semaphores are bound to an event loop, so keep one per loop
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_executor(self):
+        if self._executor is None:
+            # each worker process gets its share of the thread budget
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=set_thread_budget,
+                initargs=(self.threads, self.max_workers, True),
+            )
+        return self._executor
+
+    def _get_semaphore(self, loop):
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    async def generate(
+        self,
+        input_images: str,
+        ylabels: str,
+        output: str = None,
+        image_format: str = None,
+        timeout: float = None,
+        **kwargs,
+    ) -> bytes:
+        """
+        Generate a figure without blocking the event loop.
+
+        Args:
+            input_images (str): The input images separated by comma.
+            ylabels (str): The ylabels separated by comma.
+            output (str, optional): The output file name; if None, the figure is only returned as bytes. Defaults to None.
+            image_format (str, optional): The image format to encode; if None, it is inferred from output, defaulting to png. Defaults to None.
+            timeout (float, optional): The maximum number of seconds to wait for the figure, including time spent waiting for a free slot. Defaults to None.
+            **kwargs: Any other keyword arguments of :func:`figure_generator`.
+
+        Raises:
+            asyncio.TimeoutError: The figure was not ready within timeout; a render that already started keeps its slot until it finishes, and output is not written.
+
+        Returns:
+            bytes: The encoded figure.
+        """
+        if image_format is None:
+            image_format = "png"
+            if output is not None:
+                _, ext = os.path.splitext(output)
+                if ext != "":
+                    image_format = ext[1:].lower()
+
+        kwargs.update({"input_images": input_images, "ylabels": ylabels})
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        semaphore = self._get_semaphore(loop)
+        await asyncio.wait_for(semaphore.acquire(), timeout)
+
+        def _release_slot(_):
+            try:
+                loop.call_soon_threadsafe(semaphore.release)
+            except RuntimeError:
+                # the event loop is already closed
+                pass
+
+        try:
+            render_future = self._get_executor().submit(
+                _render_figure, kwargs, image_format
+            )
+        except BaseException:
+            semaphore.release()
+            raise
+        # the slot is only released once the render has actually finished (or was dropped
+        # before starting), so that max_concurrency limits the work done by the pool even
+        # for requests that timed out or were cancelled
+        render_future.add_done_callback(_release_slot)
+
+        # cancellation (explicit or through the timeout) drops a render that has not started
+        # yet; a render that is already running cannot be stopped and finishes in its worker,
+        # but its result is discarded and output is not written
+        remaining = None if deadline is None else max(0, deadline - loop.time())
+        image_bytes = await asyncio.wait_for(
+            asyncio.wrap_future(render_future), remaining
+        )
+        if output is not None:
+            await loop.run_in_executor(None, _write_output, output, image_bytes)
+        return image_bytes
+
+    def shutdown(self, wait: bool = True):
+        """
+        Shut down the worker processes.
+
+        Args:
+            wait (bool, optional): Whether to wait for the pending figures to finish. Defaults to True.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=exc_type is None)
+
+
+_default_generator = None
+
+
+async def figure_generator_async(
+    input_images: str,
+    ylabels: str,
+    output: str = None,
+    image_format: str = None,
+    timeout: float = None,
+    **kwargs,
+) -> bytes:
+    """
+    This is the asynchronous counterpart of :func:`figure_generator`, using a process-wide :class:`AsyncFigureGenerator`.
+
+    Args:
+        input_images (str): The input images separated by comma.
+        ylabels (str): The ylabels separated by comma.
+        output (str, optional): The output file name; if None, the figure is only returned as bytes. Defaults to None.
+        image_format (str, optional): The image format to encode; if None, it is inferred from output, defaulting to png. Defaults to None.
+        timeout (float, optional): The maximum number of seconds to wait for the figure. Defaults to None.
+        **kwargs: Any other keyword arguments of :func:`figure_generator`.
+
+    Returns:
+        bytes: The encoded figure.
+    """
+    global _default_generator
+    if _default_generator is None:
+        _default_generator = AsyncFigureGenerator()
+    return await _default_generator.generate(
+        input_images, ylabels, output, image_format, timeout, **kwargs
+    )
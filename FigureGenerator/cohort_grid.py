@@ -0,0 +1,262 @@
+#!usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse, json, os, pathlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .screenshot_maker import FigureGenerator, plot_slices_grid, views
+from .utils import (
+    get_basename_sanitized,
+    get_thread_budget,
+    parse_cohort_file,
+    set_thread_budget,
+)
+
+
+def _get_subject_arguments(subject, parameters):
+    """
+    Get the arguments of :class:`FigureGenerator` for a subject of the grid.
+
+    Args:
+        subject (dict): The subject as returned by :func:`parse_cohort_file`.
+        parameters (dict): The rendering parameters, named as in :func:`generate_cohort_grid`.
+
+    Returns:
+        argparse.Namespace: The arguments for :class:`FigureGenerator`.
+    """
+    args = argparse.Namespace()
+    args.images = subject["images"]
+    # only the first mask is overlaid
+    args.masks = None
+    if subject["masks"] is not None:
+        args.masks = subject["masks"].split(",")[0]
+    # rows are labelled with the subject, so the row labels of each subject are not used
+    args.ylabels = None
+    args.output = None
+    args.axisrow = True
+    args.opacity = parameters["opacity"]
+    args.borderpc = parameters["borderpc"]
+    args.boundtype = parameters["boundtype"]
+    args.fontsize = parameters["fontsize"]
+    args.flip_sagittal = parameters["flip_sagittal"]
+    args.flip_coronal = parameters["flip_coronal"]
+    args.flip_axial = parameters["flip_axial"]
+    args.summary = parameters["summary"]
+    args.lowmemory = parameters["low_memory"]
+    return args
+
+
+def _prepare_subject(subject, parameters):
+    """
+    Read and preprocess a subject in a worker process, and return only its selected and blended slices.
+
+    Args:
+        subject (dict): The subject as returned by :func:`parse_cohort_file`.
+        parameters (dict): The rendering parameters, named as in :func:`generate_cohort_grid`.
+
+    Returns:
+        dict: The blended slice of each image and view (with the mask overlay, if any), the image labels and the selected slice of each view.
+    """
+    fig_generator = FigureGenerator(_get_subject_arguments(subject, parameters))
+    labels = [get_basename_sanitized(image) for image in fig_generator.images]
+    if subject["ylabels"] is not None:
+        labels = subject["ylabels"].split(",")
+        assert len(labels) == len(
+            fig_generator.images
+        ), "Number of images and number of ylabels should be same"
+    mask_id = 0 if fig_generator.masks else None
+    panel_specs = [
+        (image_id, mask_id, view_id)
+        for image_id in range(len(fig_generator.images))
+        for view_id in range(len(views))
+    ]
+    return {
+        "panels": [panel.array for panel in fig_generator.iter_panels(panel_specs)],
+        "labels": labels,
+        "slices": dict(zip(views, [int(i) for i in fig_generator.max_id])),
+    }
+
+
+def generate_cohort_grid(
+    cohort_file: str,
+    output: str,
+    page_rows: int = 10,
+    opacity: float = 0.5,
+    borderpc: float = 0.05,
+    boundtype: str = "mask",
+    fontsize: int = 15,
+    flip_sagittal: bool = False,
+    flip_coronal: bool = False,
+    flip_axial: bool = False,
+    summary: str = None,
+    image_format: str = None,
+    num_workers: int = None,
+    low_memory: bool = False,
+    threads: int = None,
+) -> dict:
+    """
+    Generate a figure comparing the subjects of a cohort side by side, split into pages of subjects, with one row per subject holding the selected slice of each view of each image, blended with the subject's first mask. Subjects are read and preprocessed in parallel worker processes, which only return the blended slices; rows are assembled into pages as soon as the subjects of a page are ready.
+
+    Args:
+        cohort_file (str): The cohort CSV file, as described in :func:`parse_cohort_file`; all subjects need the same number of images, and the column titles are taken from the first subject.
+        output (str): The output file name; if paged, pages are saved as "<name>_page<number><extension>" and the index as "<name>_pages.json".
+        page_rows (int, optional): The maximum number of subjects per page; if 0, all subjects are in one figure, which can get too large to render or view for large cohorts. Defaults to 10.
+        opacity (float, optional): The opacity of the masks. Defaults to 0.5.
+        borderpc (float, optional): The percentage of the bounding box to use as border. Defaults to 0.05.
+        boundtype (str, optional): The type of bounding box to use, can be "none", "image" or "mask". Defaults to "mask".
+        fontsize (int, optional): The font size for all text on the figure. Defaults to 15.
+        flip_sagittal (bool, optional): Whether to flip the sagittal view. Defaults to False.
+        flip_coronal (bool, optional): Whether to flip the coronal view. Defaults to False.
+        flip_axial (bool, optional): Whether to flip the axial view. Defaults to False.
+        summary (str, optional): The summary of the timepoints of 4D images, can be "mean" or "max"; if None, the first timepoint is shown. Defaults to None.
+        image_format (str, optional): The image format to save; if None, it is inferred from output. Defaults to None.
+        num_workers (int, optional): The number of worker processes. Defaults to None, which uses the thread budget or the number of CPUs.
+        low_memory (bool, optional): Whether the workers narrow data types early and keep only the selected slices. Defaults to False.
+        threads (int, optional): The number of threads all worker processes may use in total, split evenly across them. Defaults to None, which uses the FIGURE_GENERATOR_NUM_THREADS environment variable, falling back to the number of CPUs.
+
+    Returns:
+        dict: The description of the grid, with the rows, columns and pages as in :meth:`FigureGenerator.save_paged_image`, the selected slices of each subject and the subjects that failed.
+    """
+    subjects = parse_cohort_file(cohort_file)
+    assert len(subjects) > 0, "Cohort file has no subjects."
+    assert page_rows >= 0, "page_rows should not be negative."
+    parameters = {
+        "opacity": opacity,
+        "borderpc": borderpc,
+        "boundtype": boundtype,
+        "fontsize": fontsize,
+        "flip_sagittal": flip_sagittal,
+        "flip_coronal": flip_coronal,
+        "flip_axial": flip_axial,
+        "summary": summary,
+        "low_memory": low_memory,
+    }
+    threads = get_thread_budget(threads) or os.cpu_count() or 1
+    if num_workers is None:
+        num_workers = threads
+    num_workers = max(1, min(num_workers, len(subjects)))
+
+    output_base, ext = os.path.splitext(output)
+    output_dir = os.path.dirname(os.path.abspath(output))
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    if image_format is None:
+        image_format = ext[1:] if ext != "" else "png"
+    rows_per_page = page_rows or len(subjects)
+    grid = {
+        "output": output,
+        "rows": 0,
+        "columns": 0,
+        "subjects": [],
+        "failed": {},
+        "pages": [],
+    }
+
+    def _save_page(rows):
+        if page_rows == 0:
+            page_file = output
+        else:
+            page_file = (
+                output_base + "_page" + str(len(grid["pages"]) + 1).zfill(3) + ext
+            )
+        plot_slices_grid(
+            [panel for row in rows for panel in row["panels"]],
+            (grid["columns"], len(rows), 0),
+            [row["subject_id"] for row in rows],
+            page_file,
+            image_format,
+            column_titles=grid["column_titles"],
+            font_size=fontsize,
+        )
+        # pages are described as in :meth:`FigureGenerator.save_paged_image`
+        row_start = grid["rows"] - len(rows)
+        grid["pages"].append(
+            {
+                "page": len(grid["pages"]) + 1,
+                "file": os.path.basename(page_file),
+                "rows": [row_start, grid["rows"]],
+                "columns": [0, grid["columns"]],
+                "row_labels": [row["subject_id"] for row in rows],
+                "panels": [
+                    {"image": image, "mask": row["mask"], "view": view}
+                    for row in rows
+                    for image in row["images"]
+                    for view in views
+                ],
+            }
+        )
+
+    # each worker process gets its share of the thread budget
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=set_thread_budget,
+        initargs=(threads, num_workers, True),
+    ) as executor:
+        # keep a bounded number of subjects in flight, so that finished rows do not pile up
+        # while a page is being rendered
+        subjects_to_submit = iter(subjects)
+        pending = deque()
+
+        def _submit_next():
+            subject = next(subjects_to_submit, None)
+            if subject is not None:
+                future = executor.submit(_prepare_subject, subject, parameters)
+                pending.append((subject, future))
+
+        for _ in range(2 * num_workers):
+            _submit_next()
+
+        rows = []
+        while pending:
+            subject, future = pending.popleft()
+            _submit_next()
+            subject_id = subject["subject_id"]
+            try:
+                row = future.result()
+            except Exception as error:
+                print("WARNING: Skipping subject '" + subject_id + "': " + str(error))
+                grid["failed"][subject_id] = str(error)
+                continue
+            # the first subject defines the columns
+            if grid["columns"] == 0:
+                grid["columns"] = len(row["panels"])
+                column_labels = row["labels"]
+                grid["column_titles"] = [
+                    label + "\n" + view for label in column_labels for view in views
+                ]
+            if len(row["panels"]) != grid["columns"]:
+                error = "Number of images is not consistent with the first subject."
+                print("WARNING: Skipping subject '" + subject_id + "': " + error)
+                grid["failed"][subject_id] = error
+                continue
+            if row["labels"] != column_labels:
+                print(
+                    "WARNING: Labels of subject '"
+                    + subject_id
+                    + "' ("
+                    + ",".join(row["labels"])
+                    + ") differ from the column titles ("
+                    + ",".join(column_labels)
+                    + "), which are taken from the first subject."
+                )
+
+            row["subject_id"] = subject_id
+            row["images"] = subject["images"].split(",")
+            row["mask"] = None
+            if subject["masks"] is not None:
+                row["mask"] = subject["masks"].split(",")[0]
+            rows.append(row)
+            grid["subjects"].append({"subject_id": subject_id, "slices": row["slices"]})
+            grid["rows"] += 1
+            # only the rows of the current page are kept
+            if len(rows) == rows_per_page:
+                _save_page(rows)
+                rows = []
+        if rows:
+            _save_page(rows)
+
+    assert grid["rows"] > 0, "No subject could be prepared."
+    grid.pop("column_titles")
+    if page_rows > 0:
+        with open(output_base + "_pages.json", "w") as index_file:
+            json.dump(grid, index_file, indent=2)
+    return grid
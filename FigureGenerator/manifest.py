@@ -0,0 +1,138 @@
+#!usr/bin/env python
+# -*- coding: utf-8 -*-
+import json, os
+
+from .utils import get_file_fingerprint
+from .version import __version__
+
+
+def get_manifest_file(output_file):
+    """
+    Get the manifest file that is stored next to an output.
+
+    Args:
+        output_file (str): The output file name.
+
+    Returns:
+        str: The manifest file name.
+    """
+    return output_file + ".manifest.json"
+
+
+def create_manifest(input_files, parameters, use_hash=False):
+    """
+    Create the manifest of a figure from the fingerprints of its inputs and its rendering parameters.
+
+    Args:
+        input_files (list of str): The input images and masks (files or DICOM series directories).
+        parameters (dict): The rendering parameters; these need to be JSON-serializable.
+        use_hash (bool, optional): Whether to include the SHA-256 of the inputs, instead of relying only on size and modification time. Defaults to False.
+
+    Returns:
+        dict: The manifest.
+    """
+    return {
+        "version": __version__,
+        "inputs": [
+            get_file_fingerprint(input_file, use_hash) for input_file in input_files
+        ],
+        # round-trip through json so that the comparison with a stored manifest is exact
+        "parameters": json.loads(json.dumps(parameters, sort_keys=True)),
+    }
+
+
+## the arguments of FigureGenerator that change the rendered figure
+rendering_arguments = [
+    "ylabels",
+    "opacity",
+    "borderpc",
+    "axisrow",
+    "fontsize",
+    "boundtype",
+    "flip_sagittal",
+    "flip_coronal",
+    "flip_axial",
+    "timepoints",
+    "summary",
+    "pagerows",
+    "pagecolumns",
+]
+
+
+def create_figure_manifest(args, image_format=None, use_hash=False):
+    """
+    Create the manifest of a figure from the same arguments as :class:`FigureGenerator`.
+
+    Args:
+        args (argparse.Namespace): The arguments for :class:`FigureGenerator`.
+        image_format (str, optional): The image format to save. Defaults to None.
+        use_hash (bool, optional): Whether to include the SHA-256 of the inputs. Defaults to False.
+
+    Returns:
+        dict: The manifest.
+    """
+    input_files = args.images.split(",")
+    if args.masks is not None:
+        input_files += args.masks.split(",")
+    parameters = {
+        argument: getattr(args, argument, None) for argument in rendering_arguments
+    }
+    parameters["image_format"] = image_format
+    return create_manifest(input_files, parameters, use_hash)
+
+
+def get_output_file(output):
+    """
+    Get the output file of a figure, which is "screenshot.png" inside output if it is a directory.
+
+    Args:
+        output (str): The output file name or directory.
+
+    Returns:
+        str: The output file name.
+    """
+    if os.path.splitext(output)[1] == "":
+        return os.path.join(output, "screenshot.png")
+    return output
+
+
+def write_manifest(output_file, manifest, output_files=None):
+    """
+    Write the manifest next to an output, after the figure has been saved.
+
+    Args:
+        output_file (str): The output file name.
+        manifest (dict): The manifest as returned by :func:`create_manifest`.
+        output_files (list of str, optional): All files produced for this output (e.g., pages); if None, only output_file. Defaults to None.
+    """
+    if output_files is None:
+        output_files = [output_file]
+    manifest = dict(manifest, outputs=[os.path.abspath(f) for f in output_files])
+    with open(get_manifest_file(output_file), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def is_output_up_to_date(output_file, manifest):
+    """
+    Check whether an output was rendered from the same inputs and parameters, and all of its files still exist.
+
+    Args:
+        output_file (str): The output file name.
+        manifest (dict): The current manifest as returned by :func:`create_manifest`.
+
+    Returns:
+        bool: Whether the output can be skipped.
+    """
+    manifest_file = get_manifest_file(output_file)
+    if not os.path.exists(manifest_file):
+        return False
+    try:
+        with open(manifest_file) as f:
+            stored_manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    stored_outputs = stored_manifest.pop("outputs", [])
+    if not stored_outputs or not all(os.path.exists(f) for f in stored_outputs):
+        return False
+    return stored_manifest == manifest
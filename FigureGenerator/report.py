@@ -0,0 +1,316 @@
+#!usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64, hashlib, html, io, json, os, pathlib, re, time
+
+from .screenshot_maker import figure_generator, views
+from .manifest import create_manifest, is_output_up_to_date, write_manifest
+from .utils import get_basename_sanitized, parse_cohort_file
+
+## the file that keeps track of what has been rendered for the report
+report_state_file = "report_state.json"
+## the report state of a subject that has been rendered
+subject_state_keys = ["figure", "thumbnail", "slices", "mask_volumes"]
+
+
+def _get_subject_manifest(subject, parameters, use_hash):
+    """
+    Get the manifest of a subject's figure, combining its input files and the rendering parameters.
+
+    Args:
+        subject (dict): The subject as returned by :func:`parse_cohort_file`.
+        parameters (dict): The rendering parameters.
+        use_hash (bool): Whether to include the SHA-256 of the inputs.
+
+    Returns:
+        dict: The manifest.
+    """
+    input_files = subject["images"].split(",")
+    if subject["masks"] is not None:
+        input_files += subject["masks"].split(",")
+    return create_manifest(
+        input_files, dict(parameters, ylabels=subject["ylabels"]), use_hash
+    )
+
+
+def _get_thumbnail_data(figure, thumbnail_size):
+    """
+    Create a low-resolution PNG thumbnail of a figure, rendered again at a low resolution instead of reading back the full figure, which can exceed the decompression bomb limit of PIL.
+
+    Args:
+        figure (matplotlib.figure.Figure): The figure, as rendered by :func:`figure_generator`.
+        thumbnail_size (int): The maximum width and height of the thumbnail in pixels.
+
+    Returns:
+        bytes: The PNG-encoded thumbnail.
+    """
+    from PIL import Image
+
+    # twice the thumbnail size, so that downsampling keeps the thumbnail sharp
+    dpi = max(1, 2 * thumbnail_size / max(figure.get_size_inches()))
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png", dpi=dpi)
+    buffer.seek(0)
+    with Image.open(buffer) as image:
+        image.thumbnail((thumbnail_size, thumbnail_size))
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="png", optimize=True)
+    return buffer.getvalue()
+
+
+def _get_subject_file_name(subject_id):
+    """
+    Get a file name for a subject, so that subject IDs with path separators, relative paths or other special characters stay within the report directory.
+
+    Args:
+        subject_id (str): The subject ID.
+
+    Returns:
+        str: The file name, without extension.
+    """
+    file_name = re.sub(r"[^A-Za-z0-9._-]", "_", subject_id).lstrip(".")
+    # different subject IDs can map to the same name
+    if file_name != subject_id or file_name == "":
+        file_name += "_" + hashlib.sha256(subject_id.encode("utf-8")).hexdigest()[:8]
+    return file_name
+
+
+def _render_subject(subject, figure_file, thumbnail_file, parameters, thumbnail_size):
+    """
+    Render the figure and thumbnail of a subject.
+
+    Args:
+        subject (dict): The subject as returned by :func:`parse_cohort_file`.
+        figure_file (str): The output figure file.
+        thumbnail_file (str): The output thumbnail file.
+        parameters (dict): The keyword arguments for :func:`figure_generator`.
+        thumbnail_size (int): The maximum width and height of the thumbnail in pixels.
+
+    Returns:
+        dict: The selected slice of each view and the volume of each mask.
+    """
+    ylabels = subject["ylabels"]
+    if ylabels is None:
+        ylabels = ",".join(
+            get_basename_sanitized(image) for image in subject["images"].split(",")
+        )
+    fig_generator = figure_generator(
+        subject["images"],
+        ylabels,
+        figure_file,
+        input_mask=subject["masks"],
+        **parameters,
+    )
+    with open(thumbnail_file, "wb") as f:
+        f.write(_get_thumbnail_data(fig_generator.fig, thumbnail_size))
+
+    return {
+        "slices": dict(zip(views, [int(i) for i in fig_generator.max_id])),
+        "mask_volumes": dict(
+            zip(
+                [get_basename_sanitized(mask) for mask in fig_generator.masks],
+                fig_generator.mask_volumes,
+            )
+        ),
+    }
+
+
+def _write_report_html(output_dir, subjects, state):
+    """
+    Write the self-contained HTML contact sheet; thumbnails are embedded and link to the full figures.
+
+    Args:
+        output_dir (str): The report directory.
+        subjects (list of dict): The subjects in the order they are shown.
+        state (dict): The report state for each subject.
+
+    Returns:
+        str: The HTML file.
+    """
+    cards = []
+    for subject in subjects:
+        subject_state = state[subject["subject_id"]]
+        subject_id = html.escape(subject["subject_id"])
+        if "error" in subject_state:
+            cards.append(
+                '<div class="card failed"><h3>{}</h3><p>{}</p></div>'.format(
+                    subject_id, html.escape(subject_state["error"])
+                )
+            )
+            continue
+
+        with open(os.path.join(output_dir, subject_state["thumbnail"]), "rb") as f:
+            thumbnail_data = base64.b64encode(f.read()).decode("ascii")
+        details = [
+            "Slices: "
+            + ", ".join(
+                "{} {}".format(view, index)
+                for view, index in subject_state["slices"].items()
+            )
+        ]
+        for mask, volume in subject_state["mask_volumes"].items():
+            details.append("{}: {:.1f} mm&sup3;".format(html.escape(mask), volume))
+        cards.append(
+            '<div class="card"><h3>{}</h3><a href="{}"><img src="data:image/png;base64,{}" alt="{}"></a><p>{}</p></div>'.format(
+                subject_id,
+                html.escape(pathlib.Path(subject_state["figure"]).as_posix()),
+                thumbnail_data,
+                subject_id,
+                "<br>".join(details),
+            )
+        )
+
+    html_file = os.path.join(output_dir, "index.html")
+    with open(html_file, "w") as f:
+        f.write(
+            """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>FigureGenerator QC Report</title>
+<style>
+body { background: black; color: white; font-family: sans-serif; }
+.grid { display: flex; flex-wrap: wrap; gap: 12px; }
+.card { border: 1px solid lightgray; padding: 8px; width: 280px; }
+.card img { max-width: 100%; }
+.card h3 { margin: 0 0 8px 0; }
+.failed { border-color: red; }
+</style>
+</head>
+<body>
+<h1>FigureGenerator QC Report</h1>
+<p>"""
+            + str(len(subjects))
+            + """ subjects</p>
+<div class="grid">
+"""
+            + "\n".join(cards)
+            + """
+</div>
+</body>
+</html>
+"""
+        )
+    return html_file
+
+
+def generate_report(
+    cohort_file: str,
+    output_dir: str,
+    thumbnail_size: int = 256,
+    use_hash: bool = False,
+    **kwargs,
+) -> str:
+    """
+    Generate a static HTML QC report for a cohort, with low-resolution thumbnails linking to the full figures, and the selected slices and mask volumes of each subject. The report is regenerated incrementally: a manifest is stored next to each figure, and only subjects whose inputs or parameters changed (or whose outputs are missing) are rendered again.
+
+    Args:
+        cohort_file (str): The cohort CSV file, as described in :func:`parse_cohort_file`.
+        output_dir (str): The report directory; figures are saved in "figures", thumbnails in "thumbnails" and the report as "index.html".
+        thumbnail_size (int, optional): The maximum width and height of the thumbnails in pixels. Defaults to 256.
+        use_hash (bool, optional): Whether the manifests use the SHA-256 of the inputs instead of their modification time. Defaults to False.
+        **kwargs: Any other keyword arguments of :func:`figure_generator`, which are used for all subjects.
+
+    Returns:
+        str: The HTML file.
+    """
+    subjects = parse_cohort_file(cohort_file)
+    subject_ids = [subject["subject_id"] for subject in subjects]
+    assert len(set(subject_ids)) == len(subject_ids), "Subject IDs are not unique."
+
+    for sub_dir in ["figures", "thumbnails"]:
+        pathlib.Path(os.path.join(output_dir, sub_dir)).mkdir(
+            parents=True, exist_ok=True
+        )
+
+    state_file = os.path.join(output_dir, report_state_file)
+    previous_state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            previous_state = json.load(f)
+
+    parameters = dict(kwargs, thumbnail_size=thumbnail_size)
+    state = {}
+    for subject in subjects:
+        subject_id = subject["subject_id"]
+        file_name = _get_subject_file_name(subject_id) + ".png"
+        figure_file = os.path.join("figures", file_name)
+        thumbnail_file = os.path.join("thumbnails", file_name)
+        try:
+            manifest = _get_subject_manifest(subject, parameters, use_hash)
+        except OSError as error:
+            print("WARNING: Skipping subject '" + subject_id + "': " + str(error))
+            state[subject_id] = {"error": str(error)}
+            continue
+
+        # the manifest next to the figure tracks the inputs, parameters and outputs; the
+        # report state is also needed, since it holds what is shown for the subject
+        subject_state = previous_state.get(subject_id, {})
+        if all(key in subject_state for key in subject_state_keys) and (
+            is_output_up_to_date(os.path.join(output_dir, figure_file), manifest)
+        ):
+            state[subject_id] = subject_state
+            continue
+
+        print("Rendering subject '" + subject_id + "'")
+        try:
+            subject_state = _render_subject(
+                subject,
+                os.path.join(output_dir, figure_file),
+                os.path.join(output_dir, thumbnail_file),
+                kwargs,
+                thumbnail_size,
+            )
+        except Exception as error:
+            print(
+                "WARNING: Rendering subject '" + subject_id + "' failed: " + str(error)
+            )
+            state[subject_id] = {"error": str(error)}
+            continue
+        write_manifest(
+            os.path.join(output_dir, figure_file),
+            manifest,
+            [
+                os.path.join(output_dir, figure_file),
+                os.path.join(output_dir, thumbnail_file),
+            ],
+        )
+        subject_state.update({"figure": figure_file, "thumbnail": thumbnail_file})
+        state[subject_id] = subject_state
+
+    with open(state_file, "w") as f:
+        json.dump(state, f, indent=2)
+
+    return _write_report_html(output_dir, subjects, state)
+
+
+def watch_report(
+    cohort_file: str,
+    output_dir: str,
+    interval: float = 60,
+    iterations: int = None,
+    **kwargs,
+) -> str:
+    """
+    Keep a report up to date by regenerating it periodically; since only new or changed subjects are rendered, subjects added to the cohort file (or updated inputs) are picked up as they appear. This polls the cohort file and the inputs it lists, not a directory, so new subjects need to be added to the cohort file.
+
+    Args:
+        cohort_file (str): The cohort CSV file, as described in :func:`parse_cohort_file`.
+        output_dir (str): The report directory.
+        interval (float, optional): The number of seconds between checks. Defaults to 60.
+        iterations (int, optional): The number of checks; if None, the report is watched until interrupted. Defaults to None.
+        **kwargs: Any other keyword arguments of :func:`generate_report`.
+
+    Returns:
+        str: The HTML file.
+    """
+    html_file = None
+    iteration = 0
+    try:
+        while iterations is None or iteration < iterations:
+            if iteration > 0:
+                time.sleep(interval)
+            html_file = generate_report(cohort_file, output_dir, **kwargs)
+            iteration += 1
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    return html_file
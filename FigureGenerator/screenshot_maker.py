@@ -1,14 +1,32 @@
 #!usr/bin/env python
 # -*- coding: utf-8 -*-
-import os, pathlib
+import io, json, math, os, pathlib, tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from .utils import (
     sanity_checker_base,
+    get_image_information,
+    read_image,
+    get_number_of_timepoints,
+    read_timepoint,
+    get_timepoint_summary,
+    decompress_image,
     resample_image,
     rescale_intensity,
+    cast_to_label_image,
+    get_peak_memory_usage,
+    get_thread_budget,
+    get_threads_per_worker,
     get_bounding_box,
     alpha_blend,
     get_basename_sanitized,
 )
+from .manifest import (
+    create_figure_manifest,
+    get_output_file,
+    is_output_up_to_date,
+    write_manifest,
+)
 import SimpleITK as sitk
 import numpy as np
 
@@ -18,6 +36,110 @@ import matplotlib.pyplot as plt
 
 # check logic in https://github.com/pyushkevich/upenn_be5370_utils/blob/main/upenn_be5370_utils/sitkview.py
 
+## the order of the views for each image
+views = ["Sagittal", "Coronal", "Axial"]
+
+## a single panel of the figure, as generated by FigureGenerator.iter_panels()
+Panel = namedtuple(
+    "Panel", ["index", "axis", "image_index", "mask_index", "array", "label"]
+)
+
+
+def plot_slices_grid(
+    images_blended,
+    layout,
+    ylabel_titles,
+    output_file,
+    image_format=None,
+    column_titles=None,
+    dpi=600,
+    font_size=15,
+):
+    """
+    Plot slices in a grid and save the figure.
+
+    Args:
+        images_blended (iterable of numpy.ndarray): The blended slices, in row-major order.
+        layout (tuple): The layout as (columns, rows, 0).
+        ylabel_titles (list of str): The ylabel for each row.
+        output_file (Union[str, file-like]): The output file name or a writable binary file-like object.
+        image_format (str, optional): The image format; if None, it is inferred from output_file. Defaults to None.
+        column_titles (list of str, optional): The titles of the first row; if None, the views are used. Defaults to None.
+        dpi (int, optional): The resolution of the figure. Defaults to 600.
+        font_size (int, optional): The font size for all text on the figure. Defaults to 15.
+
+    Returns:
+        matplotlib.figure.Figure: The (closed) figure.
+    """
+    # start the plotting
+    fig, _ = plt.subplots(
+        layout[1],
+        layout[0],
+        figsize=(layout[0] * 5 / 2, layout[1] * 5 / 2),
+    )
+    # set plot properties
+    fig.set_dpi(dpi)
+    plt.subplots_adjust(wspace=0, hspace=0)
+    plt.rcParams.update(
+        {
+            "lines.color": "white",
+            "patch.edgecolor": "white",
+            "text.color": "white",
+            "axes.facecolor": "white",
+            "axes.edgecolor": "lightgray",
+            "axes.labelcolor": "white",
+            "xtick.color": "white",
+            "ytick.color": "white",
+            "grid.color": "lightgray",
+            "figure.facecolor": "black",
+            "figure.edgecolor": "black",
+            "savefig.facecolor": "black",
+            "savefig.edgecolor": "black",
+        }
+    )
+    plt.rc("font", size=font_size)
+
+    # we only want the titles for first row
+    counter = 0
+    ylabel_counter = 0
+    for ax, img in zip(fig.axes, images_blended):
+        ax.imshow(img)
+        # ax.axis("off")
+
+        # ax.set_ylabel("test", color="white")
+        counter += 1
+        if counter <= layout[0]:
+            if column_titles is not None:
+                ax.set_title(column_titles[counter - 1])
+            elif counter % 3 == 1:
+                ax.set_title("Sagittal")
+            elif counter % 3 == 2:
+                ax.set_title("Coronal")
+            elif counter % 3 == 0:
+                ax.set_title("Axial")
+            ax.title.set_color("white")
+
+        if counter == 1:
+            ax.set_ylabel(
+                ylabel_titles[ylabel_counter],
+                color="white",
+                size=font_size,
+            )
+            ylabel_counter += 1
+        elif (counter - 1) % layout[0] == 0:
+            ax.set_ylabel(
+                ylabel_titles[ylabel_counter],
+                color="white",
+                size=font_size,
+            )
+            ylabel_counter += 1
+
+    plt.tight_layout()
+    plt.savefig(output_file, format=image_format, dpi=dpi)
+    # release the figure so that long-running processes do not accumulate memory
+    plt.close(fig)
+    return fig
+
 
 class FigureGenerator:
     def __init__(self, args):
@@ -31,9 +153,10 @@ class FigureGenerator:
         else:
             self.masks = []
 
-        self.flip_sagittal = args.flip_sagittal
-        self.flip_coronal = args.flip_coronal
-        self.flip_axial = args.flip_axial
+        # flips are not exposed in the command line, so default to no flipping
+        self.flip_sagittal = getattr(args, "flip_sagittal", False)
+        self.flip_coronal = getattr(args, "flip_coronal", False)
+        self.flip_axial = getattr(args, "flip_axial", False)
         # initialize members
         ## not using slice because it's calculation after resampling is a pain
         # if args.slice is not None:
@@ -44,6 +167,27 @@ class FigureGenerator:
         self.border_pc = args.borderpc
         self.axisrow = args.axisrow
         self.font_size = args.fontsize
+        # narrow data types early and keep only the selected slices; not all callers define this
+        self.low_memory = getattr(args, "lowmemory", False)
+        # number of threads used to prepare panels and decode DICOM slices; None uses the thread budget
+        self.num_workers = getattr(args, "numworkers", None)
+        # the thread budget is only applied if configured, otherwise SimpleITK's defaults are kept
+        self.num_threads = get_thread_budget(getattr(args, "threads", None))
+        if self.num_threads is not None:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(self.num_threads)
+        # paging options; columns are kept in groups of views
+        self.page_rows = getattr(args, "pagerows", 0) or 0
+        self.page_columns = getattr(args, "pagecolumns", 0) or 0
+        if self.page_columns > 0:
+            view_groups = int(math.ceil(self.page_columns / len(views)))
+            self.page_columns = view_groups * len(views)
+        # options for 4D images; not all callers define these
+        self.timepoints = getattr(args, "timepoints", None)
+        self.summary = getattr(args, "summary", None)
+        if self.summary is not None:
+            self.summary = self.summary.lower()
+            if self.summary == "none":
+                self.summary = None
 
         ## this is used for y-axis in subplots
         self.ylabel_titles = args.ylabels
@@ -112,17 +256,23 @@ class FigureGenerator:
 
         # if a file is not present in output, use a default value
         self.output = args.output
-        _, ext = os.path.splitext(self.output)
-        if ext == "" or ext is None:
+        # output can also be a file-like object (e.g., io.BytesIO), in which case no path handling is needed
+        ext = None
+        if isinstance(self.output, str):
+            _, ext = os.path.splitext(self.output)
+        if ext == "":
             pathlib.Path(self.output).mkdir(parents=True, exist_ok=True)
             self.output = os.path.join(self.output, "screenshot.png")
-            # if screenshot exists before, then do not overwrite
-            if os.path.exists(self.output):
+            # if screenshot exists before, then do not overwrite; when skipping unchanged outputs,
+            # the screenshot is tracked by its manifest, so it is updated in place
+            overwrite = getattr(args, "skipunchanged", False)
+            if os.path.exists(self.output) and not overwrite:
                 print(
                     "Default output file was existing before, using process ID to ensure overwriting does not occur"
                 )
                 self.output = os.path.join(
-                    self.output, "screenshot_" + os.getpid() + ".png"
+                    os.path.dirname(self.output),
+                    "screenshot_" + str(os.getpid()) + ".png",
                 )
 
         # adjust the layout for plotting
@@ -133,48 +283,113 @@ class FigureGenerator:
 
         ## sanity checker
         # read the first image and save that for comparison
-        file_reader_base = sitk.ImageFileReader()
-        file_reader_base.SetFileName(self.images[0])
-        file_reader_base.ReadImageInformation()
+        file_reader_base = get_image_information(self.images[0])
 
-        assert file_reader_base.GetDimension() == 3, "Image dimension is not 3D."
+        dimension = file_reader_base.GetDimension()
+        assert dimension in [3, 4], "Image dimension is not 3D or 4D."
+        self.is_timeseries = dimension == 4
 
         if sanity_checker_base(file_reader_base, self.images[1:]):
-            # only check masks if sanity check for images passes
-            sanity_checker_base(file_reader_base, self.masks)
+            # only check masks if sanity check for images passes; masks are 3D for 4D images
+            sanity_checker_base(
+                file_reader_base, self.masks, spatial_only=self.is_timeseries
+            )
+
+        if self.is_timeseries:
+            number_of_timepoints = file_reader_base.GetSize()[3]
+            for image in self.images[1:]:
+                if get_number_of_timepoints(image) != number_of_timepoints:
+                    raise ValueError("Timepoints for subject are not consistent.")
+            for mask in self.masks:
+                if get_number_of_timepoints(mask) != 1:
+                    raise ValueError("Masks for 4D images should be 3D.")
+
+            if self.timepoints is None or self.timepoints.lower() == "all":
+                self.timepoints = list(range(number_of_timepoints))
+            else:
+                self.timepoints = [int(t) for t in self.timepoints.split(",")]
+            for timepoint in self.timepoints:
+                assert (
+                    0 <= timepoint < number_of_timepoints
+                ), "Timepoint {} is out of range.".format(timepoint)
+            assert self.summary in [None, "mean", "max"], "Unknown summary."
+            # volumes are processed one timepoint at a time, starting with the first one
+            self.current_timepoint = self.timepoints[0]
+            # compressed series are decompressed once, instead of for every timepoint
+            self.timeseries_files = {}
+            if len(self.timepoints) > 1:
+                self.temporary_dir = tempfile.TemporaryDirectory()
+                self.timeseries_files = {
+                    image: decompress_image(image, self.temporary_dir.name)
+                    for image in self.images
+                }
 
         self.read_images_and_store_arrays()
 
-    def read_images_and_store_arrays(self):
-        input_images = [
-            rescale_intensity(resample_image(sitk.ReadImage(image)))
-            for image in self.images
-        ]
+    def read_input_image(self, image_file):
+        """
+        Read an input image as a 3D volume; for 4D images, this is either the current timepoint or the summary across timepoints.
+
+        Args:
+            image_file (str): The input image file or DICOM series directory.
+
+        Returns:
+            SimpleITK.Image: The input volume.
+        """
+        if not self.is_timeseries:
+            # DICOM slices are decoded within the thread budget
+            return read_image(image_file, self.num_workers or self.num_threads)
+        image_file = self.timeseries_files.get(image_file, image_file)
+        if self.summary is not None:
+            return get_timepoint_summary(image_file, self.timepoints, self.summary)
+        return read_timepoint(image_file, self.current_timepoint)
+
+    def read_and_preprocess_image(self, image_file):
+        """
+        Read an input image, resample it and window its intensities; in low-memory mode, it is narrowed to uint8 right after windowing.
+
+        Args:
+            image_file (str): The input image file or DICOM series directory.
+
+        Returns:
+            SimpleITK.Image: The preprocessed image.
+        """
+        image = rescale_intensity(resample_image(self.read_input_image(image_file)))
+        if self.low_memory:
+            image = sitk.Cast(image, sitk.sitkUInt8)
+        return image
+
+    def read_and_preprocess_mask(self, mask_file):
+        """
+        Read a mask and resample it; in low-memory mode, it is narrowed to the smallest label type right after reading.
+
+        Args:
+            mask_file (str): The mask file or DICOM series directory.
+
+        Returns:
+            SimpleITK.Image: The preprocessed mask.
+        """
+        mask = read_image(mask_file, self.num_workers or self.num_threads)
+        if self.low_memory:
+            mask = cast_to_label_image(mask)
+        return resample_image(mask, interpolator=sitk.sitkNearestNeighbor)
 
-        input_masks = None
+    def read_images_and_store_arrays(self):
+        # only the first image and mask are needed in full to get the bounding box; the rest are
+        # bounded as soon as they are read, so that only one full volume is held at any time
+        self.volume_slices = {}
+        first_image = self.read_and_preprocess_image(self.images[0])
+        first_mask = None
         if self.mask_present:
-            input_masks = [
-                (
-                    (
-                        resample_image(
-                            sitk.ReadImage(mask), interpolator=sitk.sitkNearestNeighbor
-                        )
-                    )
-                )
-                for mask in self.masks
-            ]
+            first_mask = self.read_and_preprocess_mask(self.masks[0])
 
         ## 3d-specific calculations start here.
         if self.calculate_bounds:
-            bounding_box = get_bounding_box(
-                input_images[0], input_images[0], self.border_pc
-            )
+            bounding_box = get_bounding_box(first_image, first_image, self.border_pc)
         elif self.calculate_bounds_mask:
-            bounding_box = get_bounding_box(
-                input_images[0], input_masks[0], self.border_pc
-            )
+            bounding_box = get_bounding_box(first_image, first_mask, self.border_pc)
         else:
-            bounding_box = get_bounding_box(input_images[0], None, None)
+            bounding_box = get_bounding_box(first_image, None, None)
 
         extract = sitk.ExtractImageFilter()
         extract.SetSize(
@@ -186,48 +401,34 @@ class FigureGenerator:
         )
         extract.SetIndex([bounding_box[0], bounding_box[2], bounding_box[4]])
 
-        # get the bounded image and masks in the form of arrays
-        if len(input_images[0].GetSize()) == 3:
-            self.input_images_bounded = [
-                image[
-                    bounding_box[0] : bounding_box[1] + 1,
-                    bounding_box[2] : bounding_box[3] + 1,
-                    bounding_box[4] : bounding_box[5] + 1,
-                ]
-                for image in input_images
-            ]
-            self.image_is_2d = False
-        elif len(input_images[0].GetSize()) == 2:
-            # raise NotImplementedError("2D not yet supported")
-            self.input_images_bounded = [
-                image[
-                    bounding_box[0] : bounding_box[1] + 1,
-                    bounding_box[2] : bounding_box[3] + 1,
-                    :,
-                ]
-                for image in input_images
-            ]
-            self.image_is_2d = True
+        self.image_is_2d = len(first_image.GetSize()) == 2
+        # kept so that later timepoints of 4D images are cropped the same way
+        self.bounding_box = bounding_box
+        _get_bounded = self.get_bounded_volume
 
+        def _get_mask_volume(mask):
+            # the volume of each mask in physical units (mm^3 for most medical images)
+            return np.count_nonzero(sitk.GetArrayViewFromImage(mask)) * float(
+                np.prod(mask.GetSpacing())
+            )
+
+        self.input_images_bounded = [_get_bounded(first_image)]
+        del first_image
+        for image_file in self.images[1:]:
+            self.input_images_bounded.append(
+                _get_bounded(self.read_and_preprocess_image(image_file))
+            )
+
+        self.mask_volumes = []
         if self.mask_present:
-            if len(input_images[0].GetSize()) == 3:
-                self.input_masks_bounded = [
-                    image[
-                        bounding_box[0] : bounding_box[1] + 1,
-                        bounding_box[2] : bounding_box[3] + 1,
-                        bounding_box[4] : bounding_box[5] + 1,
-                    ]
-                    for image in input_masks
-                ]
-            elif len(input_images[0].GetSize()) == 2:
-                self.input_masks_bounded = [
-                    image[
-                        bounding_box[0] : bounding_box[1] + 1,
-                        bounding_box[2] : bounding_box[3] + 1,
-                        :,
-                    ]
-                    for image in input_masks
-                ]
+            self.mask_volumes.append(_get_mask_volume(first_mask))
+            self.input_masks_bounded = [_get_bounded(first_mask)]
+            del first_mask
+            for mask_file in self.masks[1:]:
+                mask = self.read_and_preprocess_mask(mask_file)
+                self.mask_volumes.append(_get_mask_volume(mask))
+                self.input_masks_bounded.append(_get_bounded(mask))
+                del mask
 
             # loop over each axis and get index with largest area
             max_nonzero = 0
@@ -278,12 +479,75 @@ class FigureGenerator:
 
         self.max_id = max_id
 
-    def get_image_and_mask_slices(self, image_list):
+        # in low-memory mode, only the selected slices are kept
+        if self.low_memory:
+            for image_id, image in enumerate(self.input_images_bounded):
+                self.volume_slices[("image", image_id)] = (
+                    self.get_image_and_mask_slices([image])[0]
+                )
+            if self.mask_present:
+                for mask_id, mask in enumerate(self.input_masks_bounded):
+                    self.volume_slices[("mask", mask_id)] = (
+                        self.get_image_and_mask_slices([mask])[0]
+                    )
+            self.input_images_bounded, self.input_masks_bounded = None, None
+
+    def get_bounded_volume(self, image):
+        """
+        Crop a volume to the bounding box computed by :meth:`read_images_and_store_arrays`.
+
+        Args:
+            image (SimpleITK.Image): The preprocessed image or mask.
+
+        Returns:
+            SimpleITK.Image: The bounded volume.
+        """
+        # get the bounded image and masks in the form of arrays
+        bounding_box = self.bounding_box
+        if self.image_is_2d:
+            # raise NotImplementedError("2D not yet supported")
+            return image[
+                bounding_box[0] : bounding_box[1] + 1,
+                bounding_box[2] : bounding_box[3] + 1,
+                :,
+            ]
+        return image[
+            bounding_box[0] : bounding_box[1] + 1,
+            bounding_box[2] : bounding_box[3] + 1,
+            bounding_box[4] : bounding_box[5] + 1,
+        ]
+
+    def read_images_for_timepoint(self, timepoint):
+        """
+        Read the images of a 4D series at another timepoint; the bounding box, selected slices and masks of the first timepoint are kept, so that all timepoints are cropped and sliced the same way and masks are only processed once.
+
+        Args:
+            timepoint (int): The timepoint to read.
+        """
+        if timepoint == self.current_timepoint:
+            return
+        self.current_timepoint = timepoint
+        input_images_bounded = []
+        for image_id, image_file in enumerate(self.images):
+            image = self.get_bounded_volume(self.read_and_preprocess_image(image_file))
+            if self.low_memory:
+                # only the selected slices are kept
+                self.volume_slices[("image", image_id)] = (
+                    self.get_image_and_mask_slices([image])[0]
+                )
+            else:
+                input_images_bounded.append(image)
+            del image
+        if not self.low_memory:
+            self.input_images_bounded = input_images_bounded
+
+    def get_image_and_mask_slices(self, image_list, num_threads=None):
         """
         Function to get the image and mask slices from the input array.
 
         Args:
             image_list (list of SimpleITK.Image): The array list to get the slices from.
+            num_threads (int, optional): The number of threads used to flip each volume. Defaults to None, which uses SimpleITK's global number of threads.
 
         Returns:
             list of list of SimpleITK.Image: The list of list of image and mask slices.
@@ -296,113 +560,394 @@ class FigureGenerator:
                 current_image_slices.append(image[:, self.max_id[1]])
             else:
                 flip_values = [self.flip_sagittal, self.flip_coronal, self.flip_axial]
-                flipped_image = sitk.Flip(image, flip_values)
+                filter_flip = sitk.FlipImageFilter()
+                filter_flip.SetFlipAxes(flip_values)
+                if num_threads is not None:
+                    filter_flip.SetNumberOfThreads(num_threads)
+                flipped_image = filter_flip.Execute(image)
                 current_image_slices.append(flipped_image[self.max_id[0], :, :])
                 current_image_slices.append(flipped_image[:, self.max_id[1], :])
                 current_image_slices.append(flipped_image[:, :, self.max_id[2]])
             output_slices.append(current_image_slices)
         return output_slices
 
-    def save_image(self, output_file):
-        image_slices = self.get_image_and_mask_slices(self.input_images_bounded)
-        mask_slices = None
-        if self.input_masks_bounded is not None:
-            mask_slices = self.get_image_and_mask_slices(self.input_masks_bounded)
+    def save_image(self, output_file, image_format=None):
+        """
+        Render the figure and save it.
+
+        Args:
+            output_file (Union[str, file-like]): The output file name or a writable binary file-like object.
+            image_format (str, optional): The image format (e.g., "png", "jpg"); if None, it is inferred from the file name, defaulting to png for file-like objects. Defaults to None.
+        """
+        # keep track of all files that are written, which are recorded in manifests
+        self.output_files = [output_file] if isinstance(output_file, str) else []
+        if self.page_rows > 0 or self.page_columns > 0:
+            pages = self.save_paged_image(output_file, image_format)
+            output_base = os.path.splitext(output_file)[0]
+            self.output_files = [output_base + "_pages.json"] + [
+                os.path.join(os.path.dirname(output_file), page["file"])
+                for page in pages
+            ]
+        elif self.is_timeseries and self.summary is None:
+            self.save_timeseries_image(output_file, image_format)
         else:
-            mask_slices = [[None] * len(slice) for slice in image_slices]
+            # panels are drawn as soon as they are ready
+            self.plot_blended_slices(
+                (panel.array for panel in self.iter_panels()),
+                self.layout,
+                self.ylabel_titles,
+                output_file,
+                image_format,
+            )
 
-        images_blended = []
-        only_images, images_with_mask = [], []
-        # first put the image slices
-        for image_slice in image_slices:
-            for i, _ in enumerate(image_slice):
-                blended_image = alpha_blend(image_slice[i])
+        if self.low_memory:
+            print("Peak memory usage: {:.1f} MB".format(get_peak_memory_usage()))
 
-                images_blended.append(blended_image)
-                only_images.append(blended_image)
+    def get_panel_specs(self):
+        """
+        Get the description of every panel in the order they are plotted: the image slices, followed by the image slices blended with each mask.
 
-        # next, put in the image slices blended with the masks
-        if self.mask_present:
-            for mask_slice in mask_slices:
-                for image_slice in image_slices:
-                    for i, _ in enumerate(image_slice):
-                        mask = None
-                        if mask_slice[i] is not None:
-                            mask = mask_slice[i]
-
-                        blended_image = alpha_blend(image_slice[i], mask)
-                        images_with_mask.append(blended_image)
-                        images_blended.append(blended_image)
-
-        # start the plotting
-        self.fig, _ = plt.subplots(
-            self.layout[1],
-            self.layout[0],
-            figsize=(self.layout[0] * 5 / 2, self.layout[1] * 5 / 2),
-        )
-        # set plot properties
-        self.fig.set_dpi(600)
-        plt.subplots_adjust(wspace=0, hspace=0)
-        plt.rcParams.update(
-            {
-                "lines.color": "white",
-                "patch.edgecolor": "white",
-                "text.color": "white",
-                "axes.facecolor": "white",
-                "axes.edgecolor": "lightgray",
-                "axes.labelcolor": "white",
-                "xtick.color": "white",
-                "ytick.color": "white",
-                "grid.color": "lightgray",
-                "figure.facecolor": "black",
-                "figure.edgecolor": "black",
-                "savefig.facecolor": "black",
-                "savefig.edgecolor": "black",
+        Returns:
+            list of tuple: The (image index, mask index or None, view index) of each panel.
+        """
+        panel_specs = [
+            (image_id, None, view_id)
+            for image_id in range(len(self.images))
+            for view_id in range(len(views))
+        ]
+        for mask_id in range(len(self.masks)):
+            for image_id in range(len(self.images)):
+                for view_id in range(len(views)):
+                    panel_specs.append((image_id, mask_id, view_id))
+        return panel_specs
+
+    def get_number_of_workers(self, number_of_tasks):
+        """
+        Get the number of workers used to prepare panels (or decode DICOM slices).
+
+        Args:
+            number_of_tasks (int): The number of tasks to run in parallel.
+
+        Returns:
+            int: The number of workers.
+        """
+        num_workers = self.num_workers or self.num_threads or os.cpu_count() or 1
+        return max(1, min(num_workers, number_of_tasks))
+
+    def get_panel_label(self, image_id, mask_id=None):
+        """
+        Get the label of a panel from the sanitized file names of its image and mask.
+
+        Args:
+            image_id (int): The image index.
+            mask_id (int, optional): The mask index. Defaults to None.
+
+        Returns:
+            str: The label.
+        """
+        label = get_basename_sanitized(self.images[image_id])
+        if mask_id is not None:
+            label += " + " + get_basename_sanitized(self.masks[mask_id])
+        return label
+
+    def iter_panels(self, panel_specs=None):
+        """
+        Generate the requested panels one at a time, in plotting order, as soon as each is ready; this allows progressive display (e.g., in notebooks) or streaming panels to a client. Only the images and masks used by these panels are sliced. Slicing (per volume) and blending (per panel) run in parallel across a thread pool, since SimpleITK releases the GIL while filtering.
+
+        Args:
+            panel_specs (list of tuple, optional): The panels as returned by :meth:`get_panel_specs`. Defaults to None, which uses all panels.
+
+        Yields:
+            Panel: The index in panel_specs, view, image index, mask index (None for image-only panels), RGB array and label of each panel.
+        """
+        if panel_specs is None:
+            panel_specs = self.get_panel_specs()
+
+        image_ids = sorted({spec[0] for spec in panel_specs})
+        mask_ids = sorted({spec[1] for spec in panel_specs if spec[1] is not None})
+        volume_keys = [("image", i) for i in image_ids] + [
+            ("mask", i) for i in mask_ids
+        ]
+
+        def _get_volume_slices(volume_key):
+            # slices are already available in low-memory mode
+            if volume_key in self.volume_slices:
+                return self.volume_slices[volume_key]
+            volume_type, volume_id = volume_key
+            if volume_type == "image":
+                volume = self.input_images_bounded[volume_id]
+            else:
+                volume = self.input_masks_bounded[volume_id]
+            return self.get_image_and_mask_slices([volume], num_threads)[0]
+
+        # filters running concurrently in the pool share the global number of threads; each
+        # filter gets its share explicitly, so the global is never changed (extracting a
+        # single slice is too small to matter)
+        num_workers = self.get_number_of_workers(len(panel_specs))
+        num_threads = get_threads_per_worker(num_workers)
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+        try:
+            # tasks start in submission order, so every volume is being sliced before any
+            # panel waits on it, and a panel is ready as soon as its own volumes are sliced
+            volume_futures = {
+                volume_key: executor.submit(_get_volume_slices, volume_key)
+                for volume_key in volume_keys
             }
+
+            def _prepare_panel(panel_spec):
+                image_id, mask_id, view_id = panel_spec
+                mask = None
+                if mask_id is not None:
+                    mask = volume_futures[("mask", mask_id)].result()[view_id]
+                image_slice = volume_futures[("image", image_id)].result()[view_id]
+                return sitk.GetArrayFromImage(
+                    alpha_blend(image_slice, mask, num_threads=num_threads)
+                )
+
+            panel_futures = [
+                executor.submit(_prepare_panel, panel_spec)
+                for panel_spec in panel_specs
+            ]
+            for index, (panel_spec, panel_future) in enumerate(
+                zip(panel_specs, panel_futures)
+            ):
+                image_id, mask_id, view_id = panel_spec
+                yield Panel(
+                    index,
+                    views[view_id],
+                    image_id,
+                    mask_id,
+                    panel_future.result(),
+                    self.get_panel_label(image_id, mask_id),
+                )
+        finally:
+            # do not keep preparing panels if the consumer stops early
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def get_blended_slices(self, panel_specs=None):
+        """
+        Get the blended slices for the requested panels as RGB arrays.
+
+        Args:
+            panel_specs (list of tuple, optional): The panels as returned by :meth:`get_panel_specs`. Defaults to None, which uses all panels.
+
+        Returns:
+            list of numpy.ndarray: The blended slices.
+        """
+        return [panel.array for panel in self.iter_panels(panel_specs)]
+
+    def plot_blended_slices(
+        self,
+        images_blended,
+        layout,
+        ylabel_titles,
+        output_file,
+        image_format=None,
+        column_titles=None,
+        dpi=600,
+    ):
+        """
+        Plot the blended slices in a grid and save the figure.
+
+        Args:
+            images_blended (iterable of numpy.ndarray): The blended slices, in row-major order.
+            layout (tuple): The layout as (columns, rows, 0).
+            ylabel_titles (list of str): The ylabel for each row.
+            output_file (Union[str, file-like]): The output file name or a writable binary file-like object.
+            image_format (str, optional): The image format; if None, it is inferred from output_file. Defaults to None.
+            column_titles (list of str, optional): The titles of the first row; if None, the views are used. Defaults to None.
+            dpi (int, optional): The resolution of the figure. Defaults to 600.
+        """
+        self.fig = plot_slices_grid(
+            images_blended,
+            layout,
+            ylabel_titles,
+            output_file,
+            image_format,
+            column_titles,
+            dpi,
+            self.font_size,
         )
-        plt.rc("font", size=self.font_size)
-
-        # we only want the titles for first row
-        counter = 0
-        ylabel_counter = 0
-        for ax, img in zip(self.fig.axes, images_blended):
-            ax.imshow(sitk.GetArrayFromImage(img))
-            # ax.axis("off")
-
-            # ax.set_ylabel("test", color="white")
-            counter += 1
-            if counter <= self.layout[0]:
-                if counter % 3 == 1:
-                    ax.set_title("Sagittal")
-                elif counter % 3 == 2:
-                    ax.set_title("Coronal")
-                elif counter % 3 == 0:
-                    ax.set_title("Axial")
-                ax.title.set_color("white")
-
-            if counter == 1:
-                ax.set_ylabel(
-                    self.ylabel_titles[ylabel_counter],
-                    color="white",
-                    size=self.font_size,
+
+    def save_timeseries_image(self, output_file, image_format=None):
+        """
+        Render a 4D image one timepoint at a time, either as a strip with one row per timepoint or, for gif outputs, as a cine with one frame per timepoint.
+
+        Args:
+            output_file (Union[str, file-like]): The output file name or a writable binary file-like object.
+            image_format (str, optional): The image format; if None, it is inferred from output_file. Defaults to None.
+        """
+        if image_format is None and isinstance(output_file, str):
+            image_format = os.path.splitext(output_file)[1][1:]
+        is_cine = image_format is not None and image_format.lower() == "gif"
+
+        # only the blended slices (or rendered frames) are kept across timepoints, never the volumes
+        strip_slices, strip_ylabels, cine_frames = [], [], []
+        for timepoint in self.timepoints:
+            self.read_images_for_timepoint(timepoint)
+
+            if is_cine:
+                from PIL import Image
+
+                frame_buffer = io.BytesIO()
+                self.plot_blended_slices(
+                    self.get_blended_slices(),
+                    self.layout,
+                    self.ylabel_titles,
+                    frame_buffer,
+                    "png",
+                    dpi=100,
+                )
+                frame_buffer.seek(0)
+                cine_frames.append(
+                    Image.open(frame_buffer).convert("RGB").quantize(colors=256)
+                )
+            else:
+                strip_slices.extend(self.get_blended_slices())
+                strip_ylabels.append("t = " + str(timepoint))
+
+        if is_cine:
+            cine_frames[0].save(
+                output_file,
+                format="gif",
+                save_all=True,
+                append_images=cine_frames[1:],
+                duration=200,
+                loop=0,
+            )
+            return
+
+        # each row holds all views of all images (and blends) for one timepoint
+        column_titles = self.get_strip_column_titles()
+        self.plot_blended_slices(
+            strip_slices,
+            (len(column_titles), len(self.timepoints), 0),
+            strip_ylabels,
+            output_file,
+            image_format,
+            column_titles=column_titles,
+        )
+
+    def get_strip_column_titles(self):
+        """
+        Get the column titles of a time-series strip, where each row holds all panels of a timepoint.
+
+        Returns:
+            list of str: The title of each column.
+        """
+        column_labels = [
+            self.get_panel_label(image_id, mask_id)
+            for image_id, mask_id, view_id in self.get_panel_specs()
+            if view_id == 0
+        ]
+        return [label + "\n" + view for label in column_labels for view in views]
+
+    def save_paged_image(self, output_file, image_format=None):
+        """
+        Split the figure grid into pages (groups of rows) and/or tiles (groups of columns), which are rendered and written one at a time so that only one page is in memory; an index file describing the pages is written alongside.
+
+        Args:
+            output_file (str): The output file name; pages are saved as "<name>_page<number><extension>" and the index as "<name>_pages.json".
+            image_format (str, optional): The image format; if None, it is inferred from output_file. Defaults to None.
+
+        Returns:
+            list of dict: The description of each page.
+        """
+        assert isinstance(output_file, str), "Paged output needs a file name."
+        panel_specs = self.get_panel_specs()
+        is_strip = self.is_timeseries and self.summary is None
+        if is_strip:
+            # one row per timepoint, each holding all panels
+            number_of_columns, number_of_rows = len(panel_specs), len(self.timepoints)
+            row_labels = ["t = " + str(timepoint) for timepoint in self.timepoints]
+            column_titles = self.get_strip_column_titles()
+        else:
+            number_of_columns, number_of_rows = self.layout[0], self.layout[1]
+            row_labels = self.ylabel_titles
+            column_titles = [
+                views[column % len(views)] for column in range(number_of_columns)
+            ]
+
+        rows_per_page = self.page_rows or number_of_rows
+        columns_per_page = self.page_columns or number_of_columns
+        output_base, ext = os.path.splitext(output_file)
+        pages = []
+        for row_start in range(0, number_of_rows, rows_per_page):
+            row_end = min(row_start + rows_per_page, number_of_rows)
+            if is_strip:
+                # each timepoint is read once, when its rows are rendered, and its blended
+                # slices are kept until all column tiles of these rows are written
+                strip_slices = []
+                for row in range(row_start, row_end):
+                    self.read_images_for_timepoint(self.timepoints[row])
+                    strip_slices.append(self.get_blended_slices(panel_specs))
+            for column_start in range(0, number_of_columns, columns_per_page):
+                column_end = min(column_start + columns_per_page, number_of_columns)
+                page_specs, page_slices = [], []
+                for row in range(row_start, row_end):
+                    if is_strip:
+                        row_specs = panel_specs[column_start:column_end]
+                        page_slices.extend(
+                            strip_slices[row - row_start][column_start:column_end]
+                        )
+                    else:
+                        row_offset = row * number_of_columns
+                        row_specs = panel_specs[
+                            row_offset + column_start : row_offset + column_end
+                        ]
+                    page_specs.extend(row_specs)
+                if not is_strip:
+                    page_slices = self.get_blended_slices(page_specs)
+
+                page_file = output_base + "_page" + str(len(pages) + 1).zfill(3) + ext
+                self.plot_blended_slices(
+                    page_slices,
+                    (column_end - column_start, row_end - row_start, 0),
+                    row_labels[row_start:row_end],
+                    page_file,
+                    image_format,
+                    column_titles=column_titles[column_start:column_end],
                 )
-                ylabel_counter += 1
-            elif (counter - 1) % self.layout[0] == 0:
-                ax.set_ylabel(
-                    self.ylabel_titles[ylabel_counter],
-                    color="white",
-                    size=self.font_size,
+                del page_slices
+
+                pages.append(
+                    {
+                        "page": len(pages) + 1,
+                        "file": os.path.basename(page_file),
+                        "rows": [row_start, row_end],
+                        "columns": [column_start, column_end],
+                        "row_labels": row_labels[row_start:row_end],
+                        "panels": [
+                            {
+                                "image": self.images[image_id],
+                                "mask": (
+                                    None if mask_id is None else self.masks[mask_id]
+                                ),
+                                "view": views[view_id],
+                            }
+                            for image_id, mask_id, view_id in page_specs
+                        ],
+                    }
                 )
-                ylabel_counter += 1
 
-        plt.tight_layout()
-        plt.savefig(os.path.join(output_file))
+        with open(output_base + "_pages.json", "w") as index_file:
+            json.dump(
+                {
+                    "output": output_file,
+                    "rows": number_of_rows,
+                    "columns": number_of_columns,
+                    "pages": pages,
+                },
+                index_file,
+                indent=2,
+            )
+        return pages
 
 
 def figure_generator(
     input_images: str,
     ylabels: str,
-    output: str,
+    output,
     input_mask: str = None,
     opacity: float = 0.5,
     borderpc: float = 0.05,
@@ -412,14 +957,24 @@ def figure_generator(
     flip_sagittal: bool = False,
     flip_coronal: bool = False,
     flip_axial: bool = False,
-) -> None:
+    image_format: str = None,
+    timepoints: str = None,
+    summary: str = None,
+    page_rows: int = 0,
+    page_columns: int = 0,
+    num_workers: int = None,
+    low_memory: bool = False,
+    skip_unchanged: bool = False,
+    use_hash: bool = False,
+    threads: int = None,
+) -> FigureGenerator:
     """
     This is a functional interface to the class :class:`FigureGenerator`. It takes in the same arguments as the class and generates the figure.
 
     Args:
         input_images (str): The input images separated by comma. The images should be in the same order as the ylabels.
         ylabels (str): The ylabels separated by comma. The ylabels should be in the same order as the input images.
-        output (str): The output file name.
+        output (Union[str, file-like]): The output file name or a writable binary file-like object.
         input_mask (str, optional): The input masks separated by comma. The masks should be in the same order as the input images. Defaults to None.
         opacity (float, optional): The opacity of the mask. Defaults to 0.5.
         borderpc (float, optional): The border percentage of the mask. Defaults to 0.05.
@@ -429,6 +984,19 @@ def figure_generator(
         flip_sagittal (bool, optional): Whether to flip the sagittal image. Defaults to False.
         flip_coronal (bool, optional): Whether to flip the coronal image. Defaults to False.
         flip_axial (bool, optional): Whether to flip the axial image. Defaults to False.
+        image_format (str, optional): The image format to save; if None, it is inferred from the output. Defaults to None.
+        timepoints (str, optional): The 0-based timepoints of 4D images separated by comma. Defaults to None, which uses all timepoints.
+        summary (str, optional): The summary of the timepoints of 4D images, can be "mean" or "max"; if None, each timepoint is shown. Defaults to None.
+        page_rows (int, optional): The maximum number of rows per page; if 0, rows are not split. Defaults to 0.
+        page_columns (int, optional): The maximum number of columns per page, rounded up to a multiple of 3; if 0, columns are not split. Defaults to 0.
+        num_workers (int, optional): The number of threads used to prepare panels and decode DICOM slices. Defaults to None, which uses the thread budget or all CPUs.
+        low_memory (bool, optional): Whether to narrow images to uint8 and masks to uint8/uint16 early, and keep only the selected slices. Defaults to False.
+        skip_unchanged (bool, optional): Whether to skip rendering if the manifest next to the output shows the same inputs and parameters; a manifest is written after rendering. Defaults to False.
+        use_hash (bool, optional): Whether the manifest uses the SHA-256 of the inputs instead of their modification time. Defaults to False.
+        threads (int, optional): The number of threads SimpleITK and the worker pools may use in total. Defaults to None, which uses the FIGURE_GENERATOR_NUM_THREADS environment variable, if set.
+
+    Returns:
+        FigureGenerator: The figure generator, which holds the selected slices and mask volumes; None if rendering was skipped.
     """
     assert len(input_images.split(",")) == len(
         ylabels.split(",")
@@ -449,5 +1017,25 @@ def figure_generator(
     args_for_fig_gen.flip_sagittal = flip_sagittal
     args_for_fig_gen.flip_coronal = flip_coronal
     args_for_fig_gen.flip_axial = flip_axial
+    args_for_fig_gen.timepoints = timepoints
+    args_for_fig_gen.summary = summary
+    args_for_fig_gen.pagerows = page_rows
+    args_for_fig_gen.pagecolumns = page_columns
+    args_for_fig_gen.numworkers = num_workers
+    args_for_fig_gen.lowmemory = low_memory
+    args_for_fig_gen.threads = threads
+    args_for_fig_gen.skipunchanged = skip_unchanged
+
+    manifest = None
+    if skip_unchanged:
+        assert isinstance(output, str), "Skipping unchanged outputs needs a file name."
+        manifest = create_figure_manifest(args_for_fig_gen, image_format, use_hash)
+        if is_output_up_to_date(get_output_file(output), manifest):
+            print("Output is up to date, skipping:", output)
+            return None
+
     fig_generator = FigureGenerator(args_for_fig_gen)
-    fig_generator.save_image(args_for_fig_gen.output)
+    fig_generator.save_image(fig_generator.output, image_format=image_format)
+    if manifest is not None:
+        write_manifest(fig_generator.output, manifest, fig_generator.output_files)
+    return fig_generator
@@ -1,5 +1,25 @@
-import math, os
+import csv, gzip, hashlib, math, os, shutil
+from concurrent.futures import ThreadPoolExecutor
 import SimpleITK as sitk
+import numpy as np
+
+## integer pixel types that masks can be narrowed from
+label_pixel_types = [
+    sitk.sitkUInt8,
+    sitk.sitkInt8,
+    sitk.sitkUInt16,
+    sitk.sitkInt16,
+    sitk.sitkUInt32,
+    sitk.sitkInt32,
+    sitk.sitkUInt64,
+    sitk.sitkInt64,
+]
+
+## absolute tolerance when comparing the origin, direction and spacing of headers
+header_tolerance = 1e-4
+
+## environment variable with the number of threads each process may use
+thread_budget_variable = "FIGURE_GENERATOR_NUM_THREADS"
 
 ## color_map look-up table
 # colomap_lut = {
@@ -20,6 +40,59 @@ import SimpleITK as sitk
 # }
 
 
+def get_thread_budget(threads=None):
+    """
+    Get the number of threads the current process may use, either explicitly or from the FIGURE_GENERATOR_NUM_THREADS environment variable.
+
+    Args:
+        threads (int, optional): The explicit number of threads. Defaults to None.
+
+    Returns:
+        int: The number of threads; None if it is not configured.
+    """
+    if threads is None:
+        threads = os.environ.get(thread_budget_variable)
+        if threads is None or threads.strip() == "":
+            return None
+    threads = int(threads)
+    assert threads > 0, "Number of threads should be positive."
+    return threads
+
+
+def set_thread_budget(threads=None, num_processes=1, export=False):
+    """
+    Set the thread budget of the current process to its share of a budget split across processes, by setting SimpleITK's global number of threads.
+
+    Args:
+        threads (int, optional): The total number of threads; if None, it is read from FIGURE_GENERATOR_NUM_THREADS, falling back to the number of CPUs. Defaults to None.
+        num_processes (int, optional): The number of processes sharing the budget. Defaults to 1.
+        export (bool, optional): Whether to also export the share through FIGURE_GENERATOR_NUM_THREADS, so that the worker pools of the process stay within it; this is meant for initializers of worker processes, since it affects all later calls in the process. Defaults to False.
+
+    Returns:
+        int: The number of threads of the current process.
+    """
+    threads = get_thread_budget(threads) or os.cpu_count() or 1
+    threads_per_process = max(1, threads // num_processes)
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads_per_process)
+    if export:
+        os.environ[thread_budget_variable] = str(threads_per_process)
+    return threads_per_process
+
+
+def get_threads_per_worker(num_workers):
+    """
+    Get the number of threads each worker of a pool may give its filters, so that filters running concurrently in the pool share SimpleITK's global number of threads instead of oversubscribing the CPUs; the global itself is left unchanged.
+
+    Args:
+        num_workers (int): The number of workers in the pool.
+
+    Returns:
+        int: The number of threads per worker.
+    """
+    threads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    return max(1, threads // max(1, num_workers))
+
+
 def get_basename_sanitized(file_name):
     """
     Get the basename of the input file, without the extension.
@@ -30,19 +103,292 @@ def get_basename_sanitized(file_name):
     Returns:
         str: The basename of the input file.
     """
-    temp_file = file_name
-    if file_name.endswith(".nii.gz"):
-        temp_file = file_name.replace(".nii.gz", "")
+    # DICOM series directories can have trailing separators
+    temp_file = os.path.normpath(file_name)
+    if temp_file.endswith(".nii.gz"):
+        temp_file = temp_file.replace(".nii.gz", "")
     return os.path.splitext(os.path.basename(temp_file))[0]
 
 
-def sanity_checker_base(file_reader_base, images_to_check):
+def get_file_fingerprint(file_name, use_hash=False):
+    """
+    Get a fingerprint of an input file (or all files of a DICOM series directory) to detect changes WITHOUT loading it as an image.
+
+    Args:
+        file_name (str): The input file name or DICOM series directory.
+        use_hash (bool, optional): Whether to use the SHA-256 of the contents instead of the modification time, so that touched but unchanged files are not detected as changes. Defaults to False.
+
+    Returns:
+        dict: The fingerprint.
+    """
+    if os.path.isdir(file_name):
+        files = sorted(
+            os.path.join(file_name, current_file)
+            for current_file in os.listdir(file_name)
+        )
+    else:
+        files = [file_name]
+
+    fingerprint = {"path": os.path.abspath(file_name), "files": []}
+    for current_file in files:
+        file_stat = os.stat(current_file)
+        current_fingerprint = {
+            "name": os.path.basename(current_file),
+            "size": file_stat.st_size,
+        }
+        if not use_hash:
+            current_fingerprint["mtime"] = file_stat.st_mtime
+        else:
+            hasher = hashlib.sha256()
+            with open(current_file, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    hasher.update(chunk)
+            current_fingerprint["sha256"] = hasher.hexdigest()
+        fingerprint["files"].append(current_fingerprint)
+    return fingerprint
+
+
+def parse_cohort_file(cohort_file):
+    """
+    Parse a cohort CSV file with the columns "SubjectID", "Images" and, optionally, "Masks" and "YLabels"; multiple images, masks or ylabels are comma-separated within their (quoted) field.
+
+    Args:
+        cohort_file (str): The cohort CSV file.
+
+    Raises:
+        ValueError: Required column is missing.
+
+    Returns:
+        list of dict: The subjects with keys "subject_id", "images", "masks" and "ylabels"; the last two are None if not defined.
+    """
+    subjects = []
+    with open(cohort_file, newline="") as f:
+        reader = csv.DictReader(f)
+        # column names are case-insensitive
+        columns = {column.strip().lower(): column for column in reader.fieldnames}
+        for required_column in ["subjectid", "images"]:
+            if required_column not in columns:
+                raise ValueError(
+                    "Cohort file is missing the '" + required_column + "' column."
+                )
+        for row in reader:
+            subject = {
+                "subject_id": row[columns["subjectid"]].strip(),
+                "images": row[columns["images"]].strip(),
+                "masks": None,
+                "ylabels": None,
+            }
+            for key in ["masks", "ylabels"]:
+                if key in columns and row[columns[key]].strip() != "":
+                    subject[key] = row[columns[key]].strip()
+            subjects.append(subject)
+    return subjects
+
+
+def get_dicom_series_files(directory):
+    """
+    Get the sorted slice files of the DICOM series in a directory; if there are multiple series, the one with the most slices is used.
+
+    Args:
+        directory (str): The DICOM series directory.
+
+    Raises:
+        ValueError: No DICOM series in the directory.
+
+    Returns:
+        list: The slice files, sorted by their position.
+    """
+    series_ids = sitk.ImageSeriesReader.GetGDCMSeriesIDs(directory)
+    if not series_ids:
+        raise ValueError("No DICOM series found in '" + directory + "'.")
+
+    series_files = [
+        sitk.ImageSeriesReader.GetGDCMSeriesFileNames(directory, series_id)
+        for series_id in series_ids
+    ]
+    if len(series_files) > 1:
+        print(
+            "WARNING: Multiple DICOM series found in '"
+            + directory
+            + "', using the one with the most slices."
+        )
+    return list(max(series_files, key=len))
+
+
+def _get_dicom_series_geometry(first_slice, second_slice, number_of_slices):
+    """
+    Get the geometry of a DICOM series from its first two slices, which can be either images or file readers.
+
+    Args:
+        first_slice (Union[SimpleITK.Image, SimpleITK.ImageFileReader]): The first slice.
+        second_slice (Union[SimpleITK.Image, SimpleITK.ImageFileReader]): The second slice; if None, the slice thickness is used.
+        number_of_slices (int): The number of slices in the series.
+
+    Returns:
+        tuple: The size, origin, direction and spacing of the series.
+    """
+    spacing = list(first_slice.GetSpacing())
+    if second_slice is not None:
+        spacing[2] = float(
+            np.linalg.norm(
+                np.array(second_slice.GetOrigin()) - np.array(first_slice.GetOrigin())
+            )
+        )
+    size = list(first_slice.GetSize())
+    size[2] = number_of_slices
+    return (
+        tuple(size),
+        first_slice.GetOrigin(),
+        first_slice.GetDirection(),
+        tuple(spacing),
+    )
+
+
+class DicomSeriesInformation:
+    def __init__(self, directory):
+        """
+        Header information of a DICOM series, read from its first two slices only; this mirrors the interface of SimpleITK.ImageFileReader after ReadImageInformation().
+
+        Args:
+            directory (str): The DICOM series directory.
+        """
+        files = get_dicom_series_files(directory)
+        file_readers = []
+        for file_name in files[:2]:
+            file_reader = sitk.ImageFileReader()
+            file_reader.SetFileName(file_name)
+            file_reader.ReadImageInformation()
+            file_readers.append(file_reader)
+        (
+            self.size,
+            self.origin,
+            self.direction,
+            self.spacing,
+        ) = _get_dicom_series_geometry(
+            file_readers[0],
+            file_readers[1] if len(file_readers) > 1 else None,
+            len(files),
+        )
+
+    def GetDimension(self):
+        return len(self.size)
+
+    def GetSize(self):
+        return self.size
+
+    def GetOrigin(self):
+        return self.origin
+
+    def GetDirection(self):
+        return self.direction
+
+    def GetSpacing(self):
+        return self.spacing
+
+
+def get_image_information(file_name):
+    """
+    Read the header information of an image file or DICOM series directory WITHOUT loading it into memory.
+
+    Args:
+        file_name (str): The input file name or DICOM series directory.
+
+    Returns:
+        Union[SimpleITK.ImageFileReader, DicomSeriesInformation]: The header information.
+    """
+    if os.path.isdir(file_name):
+        return DicomSeriesInformation(file_name)
+    file_reader = sitk.ImageFileReader()
+    file_reader.SetFileName(file_name)
+    file_reader.ReadImageInformation()
+    return file_reader
+
+
+def read_image(file_name, num_workers=None):
+    """
+    Read an image file or a DICOM series directory; the slices of a DICOM series are decoded in parallel.
+
+    Args:
+        file_name (str): The input file name or DICOM series directory.
+        num_workers (int, optional): The number of threads used to decode DICOM slices. Defaults to None, which uses the thread budget (see :func:`get_thread_budget`) or the number of CPUs.
+
+    Returns:
+        SimpleITK.Image: The image.
+    """
+    if not os.path.isdir(file_name):
+        return sitk.ReadImage(file_name)
+
+    files = get_dicom_series_files(file_name)
+    num_workers = max(
+        1, min(num_workers or get_thread_budget() or os.cpu_count() or 1, len(files))
+    )
+    num_threads = get_threads_per_worker(num_workers)
+
+    def _read_slice(slice_file):
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(slice_file)
+        reader.SetNumberOfThreads(num_threads)
+        return reader.Execute()
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        slices = list(executor.map(_read_slice, files))
+
+    # slices can have different pixel types if their rescale parameters differ
+    if len(set(current_slice.GetPixelID() for current_slice in slices)) > 1:
+        slices = [
+            sitk.Cast(current_slice, sitk.sitkFloat32) for current_slice in slices
+        ]
+
+    size, origin, direction, spacing = _get_dicom_series_geometry(
+        slices[0], slices[1] if len(slices) > 1 else None, len(slices)
+    )
+    image = sitk.GetImageFromArray(
+        np.concatenate(
+            [sitk.GetArrayViewFromImage(current_slice) for current_slice in slices],
+            axis=0,
+        ),
+        isVector=slices[0].GetNumberOfComponentsPerPixel() > 1,
+    )
+    assert image.GetSize() == size, "DICOM slices have inconsistent sizes."
+    image.SetOrigin(origin)
+    image.SetDirection(direction)
+    image.SetSpacing(spacing)
+    return image
+
+
+def get_spatial_information(file_reader):
+    """
+    Get the spatial (i.e., first 3 dimensions) header information from a file reader, which allows comparing 4D images with 3D ones.
+
+    Args:
+        file_reader (SimpleITK.ImageFileReader): File reader for the image, after reading its information.
+
+    Returns:
+        tuple: The origin, direction and spacing of the spatial dimensions.
+    """
+    dimension = file_reader.GetDimension()
+    spatial_dimension = min(dimension, 3)
+    direction = file_reader.GetDirection()
+    spatial_direction = tuple(
+        direction[row * dimension + column]
+        for row in range(spatial_dimension)
+        for column in range(spatial_dimension)
+    )
+    return (
+        file_reader.GetOrigin()[:spatial_dimension],
+        spatial_direction,
+        file_reader.GetSpacing()[:spatial_dimension],
+    )
+
+
+def sanity_checker_base(file_reader_base, images_to_check, spatial_only=False):
     """
     This function performs sanity check on a list of images to ensure presence of consistent header information WITHOUT loading images into memory.
 
     Args:
         file_reader_base (SimpleITK.ImageFileReader): File reader for the base image.
-        images_to_check (list): List of images paths to check.
+        images_to_check (list): List of images paths (or DICOM series directories) to check.
+        spatial_only (bool, optional): Only compare the spatial dimensions, which is used to check 3D masks against 4D images. Defaults to False.
 
     Raises:
         ValueError: Dimension mismatch in the images.
@@ -57,20 +403,46 @@ def sanity_checker_base(file_reader_base, images_to_check):
         return True
 
     for image in images_to_check:
-        file_reader_current = sitk.ImageFileReader()
-        file_reader_current.SetFileName(image)
-        file_reader_current.ReadImageInformation()
-
-        if file_reader_base.GetDimension() != file_reader_current.GetDimension():
-            raise ValueError("Dimensions for subject are not consistent.")
-
-        if file_reader_base.GetOrigin() != file_reader_current.GetOrigin():
+        file_reader_current = get_image_information(image)
+
+        if spatial_only:
+            if min(file_reader_base.GetDimension(), 3) != min(
+                file_reader_current.GetDimension(), 3
+            ):
+                raise ValueError("Dimensions for subject are not consistent.")
+
+            origin_base, direction_base, spacing_base = get_spatial_information(
+                file_reader_base
+            )
+            (
+                origin_current,
+                direction_current,
+                spacing_current,
+            ) = get_spatial_information(file_reader_current)
+        else:
+            if file_reader_base.GetDimension() != file_reader_current.GetDimension():
+                raise ValueError("Dimensions for subject are not consistent.")
+
+            origin_base, direction_base, spacing_base = (
+                file_reader_base.GetOrigin(),
+                file_reader_base.GetDirection(),
+                file_reader_base.GetSpacing(),
+            )
+            origin_current, direction_current, spacing_current = (
+                file_reader_current.GetOrigin(),
+                file_reader_current.GetDirection(),
+                file_reader_current.GetSpacing(),
+            )
+
+        # headers are compared with a tolerance, since formats store geometry with different
+        # precision (e.g., float32 in NIfTI, float64 from DICOM slice positions)
+        if not np.allclose(origin_base, origin_current, atol=header_tolerance):
             raise ValueError("Origin for subject are not consistent.")
 
-        if file_reader_base.GetDirection() != file_reader_current.GetDirection():
+        if not np.allclose(direction_base, direction_current, atol=header_tolerance):
             raise ValueError("Orientation for subject are not consistent.")
 
-        if file_reader_base.GetSpacing() != file_reader_current.GetSpacing():
+        if not np.allclose(spacing_base, spacing_current, atol=header_tolerance):
             raise ValueError("Spacing for subject are not consistent.")
 
     return True
@@ -93,12 +465,104 @@ def sanity_checker_with_files(image_file_1, image_file_2):
     Returns:
         bool: Result of sanity checking.
     """
-    file_reader_current = sitk.ImageFileReader()
-    file_reader_current.SetFileName(image_file_1)
-    file_reader_current.ReadImageInformation()
+    file_reader_current = get_image_information(image_file_1)
     return sanity_checker_base(file_reader_current, [image_file_2])
 
 
+def get_number_of_timepoints(file_name):
+    """
+    Get the number of timepoints of an image WITHOUT loading it into memory.
+
+    Args:
+        file_name (str): The input file name or DICOM series directory.
+
+    Returns:
+        int: The number of timepoints; 1 for images that are not 4D.
+    """
+    file_reader = get_image_information(file_name)
+    if file_reader.GetDimension() == 4:
+        return file_reader.GetSize()[3]
+    return 1
+
+
+def read_timepoint(file_name, timepoint):
+    """
+    Read a single 3D volume from a 4D image, without keeping the rest of the series in memory.
+
+    Args:
+        file_name (str): The input 4D file name.
+        timepoint (int): The 0-based timepoint to read.
+
+    Returns:
+        SimpleITK.Image: The 3D volume at the requested timepoint.
+    """
+    file_reader = sitk.ImageFileReader()
+    file_reader.SetFileName(file_name)
+    file_reader.ReadImageInformation()
+    size = list(file_reader.GetSize())
+    assert len(size) == 4, "Image dimension is not 4D."
+    assert 0 <= timepoint < size[3], "Timepoint is out of range."
+    # a size of 0 collapses the time dimension
+    size[3] = 0
+    file_reader.SetExtractIndex([0, 0, 0, timepoint])
+    file_reader.SetExtractSize(size)
+    return file_reader.Execute()
+
+
+def decompress_image(file_name, output_dir):
+    """
+    Decompress a gzip-compressed image (e.g., ".nii.gz") into a directory, so that its timepoints can be read directly; reading a timepoint of a compressed file needs decompressing all data before it, which makes reading all timepoints quadratic in their number.
+
+    Args:
+        file_name (str): The input file name.
+        output_dir (str): The directory to write the decompressed image to.
+
+    Returns:
+        str: The decompressed file name; file_name itself if it is not gzip-compressed.
+    """
+    if not file_name.lower().endswith(".gz"):
+        return file_name
+    # the index keeps files with the same name apart
+    output_file = os.path.join(
+        output_dir,
+        str(len(os.listdir(output_dir))) + "_" + os.path.basename(file_name)[:-3],
+    )
+    with gzip.open(file_name, "rb") as compressed, open(output_file, "wb") as output:
+        shutil.copyfileobj(compressed, output)
+    return output_file
+
+
+def get_timepoint_summary(file_name, timepoints, summary="mean"):
+    """
+    Summarize the timepoints of a 4D image into a single 3D volume, reading one volume at a time.
+
+    Args:
+        file_name (str): The input 4D file name.
+        timepoints (list): The 0-based timepoints to summarize.
+        summary (str, optional): The summary to compute; can be "mean" or "max". Defaults to "mean".
+
+    Returns:
+        SimpleITK.Image: The summary volume.
+    """
+    assert summary in ["mean", "max"], "Summary should be 'mean' or 'max'."
+    assert len(timepoints) > 0, "Please provide at least one timepoint."
+    output = None
+    for timepoint in timepoints:
+        current_volume = sitk.Cast(
+            read_timepoint(file_name, timepoint), sitk.sitkFloat32
+        )
+        if output is None:
+            output = current_volume
+        elif summary == "mean":
+            output = sitk.Add(output, current_volume)
+        else:
+            output = sitk.Maximum(output, current_volume)
+
+    if summary == "mean":
+        output = sitk.Divide(output, len(timepoints))
+    return output
+
+
 def rescale_intensity(image):
     """
     Rescale the intensity of an image.
@@ -115,6 +579,60 @@ def rescale_intensity(image):
     return rescaler.Execute(image)
 
 
+def cast_to_label_image(mask):
+    """
+    Cast a mask to the smallest unsigned integer type that holds its labels; masks that are not integer-typed or have negative labels are returned unchanged, since narrowing them would change their labels.
+
+    Args:
+        mask (SimpleITK.Image): The input mask.
+
+    Returns:
+        SimpleITK.Image: The mask as uint8, uint16 or uint32, depending on its largest label; unchanged if it cannot be narrowed without changing its labels.
+    """
+    if mask.GetPixelID() not in label_pixel_types:
+        print(
+            "WARNING: Mask is not integer-typed ("
+            + mask.GetPixelIDTypeAsString()
+            + "), keeping its data type."
+        )
+        return mask
+    min_max_filter = sitk.MinimumMaximumImageFilter()
+    min_max_filter.Execute(mask)
+    if min_max_filter.GetMinimum() < 0:
+        print("WARNING: Mask has negative labels, keeping its data type.")
+        return mask
+    for pixel_type, maximum in [
+        (sitk.sitkUInt8, 255),
+        (sitk.sitkUInt16, 65535),
+        (sitk.sitkUInt32, 4294967295),
+    ]:
+        if min_max_filter.GetMaximum() <= maximum:
+            return sitk.Cast(mask, pixel_type)
+    return mask
+
+
+def get_peak_memory_usage():
+    """
+    Get the peak resident set size (RSS) of the current process.
+
+    Returns:
+        float: The peak RSS in MB; if the platform does not provide it, the current RSS is returned.
+    """
+    try:
+        import resource, sys
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports KB, macOS reports bytes
+        if sys.platform == "darwin":
+            return peak_rss / (1024 * 1024)
+        return peak_rss / 1024
+    except ImportError:
+        import psutil
+
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, "peak_wset", memory_info.rss) / (1024 * 1024)
+
+
 def resample_image(
     img, spacing=None, size=None, interpolator=sitk.sitkLinear, outsideValue=0
 ):
@@ -250,7 +768,7 @@ def get_bounding_box(image, mask, border_pc):
             return (0, size[0] - 1, 0, size[1] - 1)
 
 
-def alpha_blend(image, mask=None, alpha=0.5):
+def alpha_blend(image, mask=None, alpha=0.5, num_threads=None):
     """
     Alpha blend an image and a mask with specified opacity.
 
@@ -260,6 +778,7 @@ def alpha_blend(image, mask=None, alpha=0.5):
         image (SimpleITK.Image): The input image.
         mask (SimpleITK.Image): The input mask. Defaults to None.
         alpha (float): The alpha value to use. Defaults to 0.5.
+        num_threads (int, optional): The number of threads of the filters. Defaults to None, which uses SimpleITK's global number of threads.
 
     Returns:
         list: The bounding box in the form of [x_min, x_max, y_min, y_max, z_min, z_max]
@@ -282,4 +801,9 @@ def alpha_blend(image, mask=None, alpha=0.5):
     filter_overlay.SetOpacity(alpha)
     # filter_overlay.SetBackgroundValue(0)
     # filter_overlay.SetColormap(r+g+b)
-    return filter_overlay.Execute(sitk.Cast(image, sitk.sitkUInt8), sitk.Cast(mask, sitk.sitkUInt8))
+    filter_cast = sitk.CastImageFilter()
+    filter_cast.SetOutputPixelType(sitk.sitkUInt8)
+    if num_threads is not None:
+        filter_overlay.SetNumberOfThreads(num_threads)
+        filter_cast.SetNumberOfThreads(num_threads)
+    return filter_overlay.Execute(filter_cast.Execute(image), filter_cast.Execute(mask))
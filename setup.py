@@ -39,7 +39,7 @@ setup(
     author_email="software@cbica.upenn.edu",
     python_requires=">=3.9",
     packages=find_packages(),
-    scripts=["figure_generator"],
+    scripts=["figure_generator", "figure_generator_report", "figure_generator_grid"],
     classifiers=[
         "Development Status :: 1 - Planning",
         "Intended Audience :: Science/Research",
@@ -0,0 +1,92 @@
+#!usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the throughput of figure generation for combinations of the thread budget and the number of worker processes.
+
+Usage: python testing/benchmark_threads.py [-threads 1,2,4] [-processes 1,2] [-figures 8]
+"""
+
+import argparse, ast, os, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FigureGenerator.screenshot_maker import figure_generator
+from FigureGenerator.utils import set_thread_budget
+
+inputDir = os.path.abspath(os.path.normpath("./testing/data"))
+images = ",".join(
+    os.path.join(inputDir, image_file)
+    for image_file in ["fl.nii.gz", "t1c.nii.gz", "t1.nii.gz", "t2.nii.gz"]
+)
+mask = os.path.join(inputDir, "seg.nii.gz")
+
+
+def _render(output):
+    figure_generator(images, "FL,T1C,T1,T2", output, input_mask=mask, boundtype="mask")
+
+
+def benchmark(threads, processes, figures, output_dir):
+    """
+    Render a number of figures with a thread budget split across worker processes.
+
+    Args:
+        threads (int): The total number of threads.
+        processes (int): The number of worker processes.
+        figures (int): The number of figures to render.
+        output_dir (str): The directory to save the figures in.
+
+    Returns:
+        float: The number of figures per second.
+    """
+    outputs = [os.path.join(output_dir, "fig_{}.png".format(i)) for i in range(figures)]
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=set_thread_budget,
+        initargs=(threads, processes, True),
+    ) as executor:
+        # warm up the workers so that process start-up is not measured
+        list(
+            executor.map(
+                set_thread_budget, [threads] * processes, [processes] * processes
+            )
+        )
+        start = time.perf_counter()
+        list(executor.map(_render, outputs))
+        return figures / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="benchmark_threads",
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="Benchmark figure generation across thread and process counts.",
+    )
+    parser.add_argument(
+        "-threads",
+        type=ast.literal_eval,
+        default=(1, 2, 4),
+        help="Total numbers of threads to try, separated by comma",
+    )
+    parser.add_argument(
+        "-processes",
+        type=ast.literal_eval,
+        default=(1, 2),
+        help="Numbers of worker processes to try, separated by comma",
+    )
+    parser.add_argument(
+        "-figures", type=int, default=8, help="Number of figures per combination"
+    )
+    args = parser.parse_args()
+    thread_counts = args.threads if isinstance(args.threads, tuple) else (args.threads,)
+    process_counts = (
+        args.processes if isinstance(args.processes, tuple) else (args.processes,)
+    )
+
+    print("CPUs: {}".format(os.cpu_count()))
+    print("{:>8} {:>10} {:>12}".format("threads", "processes", "figures/s"))
+    with tempfile.TemporaryDirectory() as output_dir:
+        for threads in thread_counts:
+            for processes in process_counts:
+                throughput = benchmark(threads, processes, args.figures, output_dir)
+                print("{:>8} {:>10} {:>12.2f}".format(threads, processes, throughput))
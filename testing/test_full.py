@@ -107,3 +107,585 @@ def test_functional_interface():
     if os.path.exists(args.output):
         os.remove(args.output)
     figure_generator(args.images,"FL,T1C,T1,T2",args.output)
+
+
+def test_async_interface():
+    import asyncio
+    from FigureGenerator.async_interface import AsyncFigureGenerator
+
+    if os.path.exists(args.output):
+        os.remove(args.output)
+
+    async def _generate():
+        async with AsyncFigureGenerator(max_workers=2) as generator:
+            return await asyncio.gather(
+                generator.generate(args.images, "FL,T1C,T1,T2", args.output),
+                generator.generate(
+                    args.images, "FL,T1C,T1,T2", input_mask=args.masks, timeout=600
+                ),
+            )
+
+    image_bytes_file, image_bytes_memory = asyncio.run(_generate())
+    assert image_bytes_file.startswith(b"\x89PNG"), "async output is not a png"
+    assert image_bytes_memory.startswith(b"\x89PNG"), "async output is not a png"
+    with open(args.output, "rb") as f:
+        assert f.read() == image_bytes_file, "async output file mismatch"
+    os.remove(args.output)
+
+    async def _timeout_and_cancel():
+        async with AsyncFigureGenerator(max_workers=1) as generator:
+            semaphore = generator._get_semaphore(asyncio.get_running_loop())
+            timed_out = False
+            try:
+                await generator.generate(
+                    args.images, "FL,T1C,T1,T2", args.output, timeout=0.01
+                )
+            except asyncio.TimeoutError:
+                timed_out = True
+            # the abandoned render keeps the only slot until it finishes
+            slot_held = semaphore.locked()
+            waiting = asyncio.ensure_future(
+                generator.generate(args.images, "FL,T1C,T1,T2")
+            )
+            await asyncio.sleep(0.1)
+            waiting.cancel()
+            cancelled = False
+            try:
+                await waiting
+            except asyncio.CancelledError:
+                cancelled = True
+            image_bytes = await generator.generate(args.images, "FL,T1C,T1,T2")
+            return timed_out, slot_held, cancelled, image_bytes, semaphore.locked()
+
+    timed_out, slot_held, cancelled, image_bytes, slot_leaked = asyncio.run(
+        _timeout_and_cancel()
+    )
+    assert timed_out and cancelled, "request not timed out or cancelled"
+    assert slot_held, "slot released before the render finished"
+    assert image_bytes.startswith(b"\x89PNG"), "async output is not a png"
+    assert not slot_leaked, "slot not released"
+    assert not os.path.exists(args.output), "output written after timeout"
+    print("Passed")
+
+
+def test_timeseries():
+    import SimpleITK as sitk
+
+    # construct a 4D image from the co-registered modalities
+    images = args.images.split(",")
+    file_4d = os.path.join(inputDir, "timeseries.nii.gz")
+    sitk.WriteImage(
+        sitk.JoinSeries([sitk.ReadImage(image) for image in images]), file_4d
+    )
+
+    for output, summary in [
+        (args.output, None),
+        (args.output, "max"),
+        (os.path.join(inputDir, "output.gif"), None),
+    ]:
+        if os.path.exists(output):
+            os.remove(output)
+        figure_generator(
+            file_4d,
+            "4D",
+            output,
+            input_mask=args.masks,
+            timepoints="0,2,3",
+            summary=summary,
+        )
+        assert os.path.exists(output), "timeseries output not created"
+        os.remove(output)
+
+    # later timepoints keep the crop, slices and masks of the first one
+    args_4d = argparse.Namespace(
+        images=file_4d,
+        masks=args.masks,
+        ylabels=None,
+        output=args.output,
+        opacity=args.opacity,
+        axisrow=True,
+        boundtype="image",
+        borderpc=args.borderpc,
+        fontsize=args.fontsize,
+        timepoints="0,2,3",
+    )
+    fig_generator = FigureGenerator(args_4d)
+    # the compressed series is decompressed once and read from there
+    from FigureGenerator.utils import read_timepoint
+
+    decompressed_file = fig_generator.timeseries_files[file_4d]
+    assert decompressed_file.endswith(".nii"), "series not decompressed"
+    assert (
+        sitk.GetArrayFromImage(read_timepoint(decompressed_file, 2))
+        == sitk.GetArrayFromImage(read_timepoint(file_4d, 2))
+    ).all(), "decompressed timepoint mismatch"
+    bounding_box, max_id = fig_generator.bounding_box, fig_generator.max_id
+    masks_bounded = fig_generator.input_masks_bounded
+    shapes = [panel.shape for panel in fig_generator.get_blended_slices()]
+    for timepoint in [2, 3]:
+        fig_generator.read_images_for_timepoint(timepoint)
+        assert fig_generator.bounding_box == bounding_box, "crop changed"
+        assert fig_generator.max_id == max_id, "slices changed"
+        assert fig_generator.input_masks_bounded is masks_bounded, "masks re-read"
+        panels = fig_generator.get_blended_slices()
+        assert [panel.shape for panel in panels] == shapes, "panel size changed"
+
+    os.remove(file_4d)
+    print("Passed")
+
+
+def test_dicom_series():
+    import shutil
+    import SimpleITK as sitk
+
+    # write the first modality as a DICOM series
+    dicom_dir = os.path.join(inputDir, "fl_dicom")
+    Path(dicom_dir).mkdir(parents=True, exist_ok=True)
+    image = sitk.Cast(sitk.ReadImage(args.images.split(",")[0]), sitk.sitkInt16)
+    # geometry that float32 NIfTI headers cannot store exactly
+    mask = sitk.ReadImage(args.masks)
+    mask_file = os.path.join(inputDir, "seg_dicom_geometry.nii.gz")
+    for volume in [image, mask]:
+        volume.SetSpacing((0.9375, 0.9375, 1.2))
+        volume.SetOrigin((-120.3, -98.7, -60.1))
+    sitk.WriteImage(mask, mask_file)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for i in range(image.GetDepth()):
+        image_slice = image[:, :, i]
+        image_slice.SetMetaData("0008|0060", "MR")
+        image_slice.SetMetaData("0020|000e", "1.2.826.0.1.3680043.2.1125.1")
+        image_slice.SetMetaData("0020|0013", str(i))
+        image_slice.SetMetaData(
+            "0020|0032",
+            "\\".join(map(str, image.TransformIndexToPhysicalPoint((0, 0, i)))),
+        )
+        image_slice.SetMetaData(
+            "0020|0037",
+            "\\".join(map(str, image.GetDirection()[0:3] + image.GetDirection()[3:6])),
+        )
+        writer.SetFileName(os.path.join(dicom_dir, str(i) + ".dcm"))
+        writer.Execute(image_slice)
+
+    assert sanity_checker_with_files(
+        dicom_dir, mask_file
+    ), "DICOM series header does not match mask"
+
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    figure_generator(dicom_dir, "FL", args.output, input_mask=mask_file)
+    assert os.path.exists(args.output), "DICOM series output not created"
+
+    # slices are decoded within an explicit thread budget, whatever the number of CPUs
+    import FigureGenerator.utils as utils
+
+    pool_sizes = []
+
+    class _RecordingExecutor(utils.ThreadPoolExecutor):
+        def __init__(self, max_workers=None, **kwargs):
+            pool_sizes.append(max_workers)
+            super().__init__(max_workers=max_workers, **kwargs)
+
+    thread_pool_executor, cpu_count = utils.ThreadPoolExecutor, utils.os.cpu_count
+    utils.ThreadPoolExecutor = _RecordingExecutor
+    utils.os.cpu_count = lambda: 32
+    try:
+        figure_generator(dicom_dir, "FL", args.output, input_mask=mask_file, threads=2)
+    finally:
+        utils.ThreadPoolExecutor = thread_pool_executor
+        utils.os.cpu_count = cpu_count
+    assert pool_sizes == [2], "DICOM decoding exceeds the thread budget"
+
+    os.remove(args.output)
+    os.remove(mask_file)
+    shutil.rmtree(dicom_dir)
+    print("Passed")
+
+
+def test_paged_output():
+    import json
+
+    output_base, ext = os.path.splitext(args.output)
+    figure_generator(
+        args.images,
+        "FL,T1C,T1,T2",
+        args.output,
+        input_mask=args.masks,
+        page_rows=3,
+        page_columns=2,
+    )
+    with open(output_base + "_pages.json") as index_file:
+        index = json.load(index_file)
+    # 8 rows of 3 views, split in 3 row pages with 1 column tile each
+    assert index["rows"] == 8 and index["columns"] == 3, "paged grid size mismatch"
+    assert len(index["pages"]) == 3, "number of pages mismatch"
+    for page in index["pages"]:
+        page_file = os.path.join(inputDir, page["file"])
+        assert os.path.exists(page_file), "page not created"
+        os.remove(page_file)
+    assert not os.path.exists(args.output), "full figure should not be created"
+    os.remove(output_base + "_pages.json")
+
+    # a 4D strip tiled in rows and columns reads each timepoint only once
+    import SimpleITK as sitk
+
+    file_4d = os.path.join(inputDir, "timeseries_paged.nii.gz")
+    sitk.WriteImage(
+        sitk.JoinSeries([sitk.ReadImage(image) for image in args.images.split(",")]),
+        file_4d,
+    )
+    args_4d = argparse.Namespace(
+        images=file_4d,
+        masks=args.masks,
+        ylabels=None,
+        output=args.output,
+        opacity=args.opacity,
+        axisrow=True,
+        boundtype="mask",
+        borderpc=args.borderpc,
+        fontsize=args.fontsize,
+        pagerows=2,
+        pagecolumns=3,
+    )
+    fig_generator = FigureGenerator(args_4d)
+    read_timepoints = []
+    read_and_preprocess_image = fig_generator.read_and_preprocess_image
+
+    def _read_and_preprocess_image(image_file):
+        read_timepoints.append(fig_generator.current_timepoint)
+        return read_and_preprocess_image(image_file)
+
+    fig_generator.read_and_preprocess_image = _read_and_preprocess_image
+    pages = fig_generator.save_paged_image(args.output)
+    # 4 timepoints of 6 panels, split in 2 row pages with 2 column tiles each
+    assert len(pages) == 4, "number of pages mismatch"
+    assert read_timepoints == [1, 2, 3], "timepoints read more than once"
+    for page in pages:
+        os.remove(os.path.join(inputDir, page["file"]))
+    os.remove(output_base + "_pages.json")
+    os.remove(file_4d)
+    print("Passed")
+
+
+def test_report():
+    import csv, json, shutil
+    from FigureGenerator.report import generate_report
+
+    report_dir = os.path.join(inputDir, "report")
+    cohort_file = os.path.join(inputDir, "cohort.csv")
+    with open(cohort_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["SubjectID", "Images", "Masks"])
+        writer.writerow(["subject_1", args.images, args.masks])
+        writer.writerow(["subject_2", args.images.split(",")[0], ""])
+        writer.writerow(["../sub/3", args.images.split(",")[0], ""])
+
+    from PIL import Image
+
+    # thumbnails are rendered at a low resolution, so large figures are never read back
+    max_image_pixels = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = 256 * 256
+    try:
+        html_file = generate_report(cohort_file, report_dir, thumbnail_size=128)
+    finally:
+        Image.MAX_IMAGE_PIXELS = max_image_pixels
+    assert os.path.exists(html_file), "report not created"
+    figure_file = os.path.join(report_dir, "figures", "subject_1.png")
+    modified_time = os.path.getmtime(figure_file)
+    with open(html_file) as f:
+        html_contents = f.read()
+    assert "subject_2" in html_contents, "subject missing in report"
+    assert "data:image/png;base64," in html_contents, "thumbnail not embedded"
+    with open(os.path.join(report_dir, "report_state.json")) as f:
+        assert "figure" in json.load(f)["../sub/3"], "subject with a path as ID failed"
+    # subject IDs with path separators stay within the report directory
+    assert sorted(os.listdir(os.path.join(report_dir, "figures")))[0].startswith(
+        "_sub_3_"
+    ), "subject ID not sanitized"
+    assert not os.path.exists(os.path.join(inputDir, "sub")), "figure outside report"
+    with Image.open(os.path.join(report_dir, "thumbnails", "subject_1.png")) as image:
+        assert max(image.size) <= 128, "thumbnail too large"
+
+    # nothing changed, so nothing should be rendered again
+    generate_report(cohort_file, report_dir, thumbnail_size=128)
+    assert os.path.getmtime(figure_file) == modified_time, "unchanged subject rendered"
+
+    # without the report state, subjects are rendered again instead of failing
+    os.remove(os.path.join(report_dir, "report_state.json"))
+    html_file = generate_report(cohort_file, report_dir, thumbnail_size=128)
+    with open(html_file) as f:
+        assert "data:image/png;base64," in f.read(), "thumbnail not embedded"
+
+    os.remove(cohort_file)
+    shutil.rmtree(report_dir)
+    print("Passed")
+
+
+def test_parallel_panels():
+    import numpy as np
+
+    args.axisrow = True
+    args.boundtype = "none"
+    args.numworkers = 1
+    panels_serial = FigureGenerator(args).get_blended_slices()
+    args.numworkers = 4
+    panels_parallel = FigureGenerator(args).get_blended_slices()
+    args.numworkers = None
+    assert len(panels_serial) == 3 * 4 * 2, "number of panels mismatch"
+    for panel_serial, panel_parallel in zip(panels_serial, panels_parallel):
+        assert np.array_equal(panel_serial, panel_parallel), "panel mismatch"
+    print("Passed")
+
+
+def test_low_memory():
+    import numpy as np
+
+    args.axisrow = True
+    args.boundtype = "mask"
+    panels = FigureGenerator(args).get_blended_slices()
+    args.lowmemory = True
+    fig_generator = FigureGenerator(args)
+    args.lowmemory = False
+    assert fig_generator.input_images_bounded is None, "volumes were kept"
+    panels_low_memory = fig_generator.get_blended_slices()
+    for panel, panel_low_memory in zip(panels, panels_low_memory):
+        assert np.array_equal(panel, panel_low_memory), "panel mismatch"
+
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    fig_generator.save_image(args.output)
+    assert os.path.exists(args.output), "low memory output not created"
+    os.remove(args.output)
+
+    # masks are only narrowed if their labels are kept
+    import SimpleITK as sitk
+    from FigureGenerator.utils import cast_to_label_image
+
+    for labels, pixel_type, expected_type in [
+        ([0, 1, 255], sitk.sitkInt16, sitk.sitkUInt8),
+        ([0, 1, 300], sitk.sitkInt32, sitk.sitkUInt16),
+        ([0, 1, 70000], sitk.sitkInt32, sitk.sitkUInt32),
+        ([-1, 0, 1], sitk.sitkInt16, sitk.sitkInt16),
+        ([0, 0.5, 1], sitk.sitkFloat32, sitk.sitkFloat32),
+    ]:
+        mask = sitk.Cast(sitk.GetImageFromArray(np.array([labels, labels])), pixel_type)
+        label_mask = cast_to_label_image(mask)
+        assert label_mask.GetPixelID() == expected_type, "mask type mismatch"
+        assert np.array_equal(
+            sitk.GetArrayFromImage(label_mask), sitk.GetArrayFromImage(mask)
+        ), "mask labels changed"
+    print("Passed")
+
+
+def test_skip_unchanged():
+    from FigureGenerator.manifest import get_manifest_file
+
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    ylabels = "FL,T1C,T1,T2"
+    assert (
+        figure_generator(args.images, ylabels, args.output, skip_unchanged=True)
+        is not None
+    ), "output should be rendered"
+    assert os.path.exists(get_manifest_file(args.output)), "manifest not created"
+    assert (
+        figure_generator(args.images, ylabels, args.output, skip_unchanged=True) is None
+    ), "unchanged output should be skipped"
+    assert (
+        figure_generator(
+            args.images, ylabels, args.output, fontsize=10, skip_unchanged=True
+        )
+        is not None
+    ), "output with changed parameters should be rendered"
+
+    # touching an input is only a change without content hashing
+    figure_generator(
+        args.images, ylabels, args.output, use_hash=True, skip_unchanged=True
+    )
+    first_image = args.images.split(",")[0]
+    os.utime(
+        first_image, (os.path.getatime(first_image), os.path.getmtime(first_image) + 10)
+    )
+    assert (
+        figure_generator(
+            args.images, ylabels, args.output, use_hash=True, skip_unchanged=True
+        )
+        is None
+    ), "touched input with same contents should be skipped"
+    assert (
+        figure_generator(args.images, ylabels, args.output, skip_unchanged=True)
+        is not None
+    ), "touched input should be rendered"
+
+    os.remove(args.output)
+    os.remove(get_manifest_file(args.output))
+
+    # a directory output keeps its screenshot, which is updated in place when changed
+    import shutil
+
+    output_dir = os.path.join(inputDir, "skip_unchanged")
+    for fontsize, expected_rendered in [(15, True), (15, False), (10, True)]:
+        rendered = figure_generator(
+            first_image, "FL", output_dir, fontsize=fontsize, skip_unchanged=True
+        )
+        assert (rendered is not None) == expected_rendered, "directory output mismatch"
+    assert sorted(os.listdir(output_dir)) == [
+        "screenshot.png",
+        "screenshot.png.manifest.json",
+    ], "screenshot not updated in place"
+    assert (
+        figure_generator(
+            first_image, "FL", output_dir, fontsize=10, skip_unchanged=True
+        )
+        is None
+    ), "updated screenshot should be skipped"
+    shutil.rmtree(output_dir)
+    print("Passed")
+
+
+def test_iter_panels():
+    args.axisrow = False
+    args.boundtype = "none"
+    fig_generator = FigureGenerator(args)
+    panels = list(fig_generator.iter_panels())
+    assert len(panels) == 3 * 4 * 2, "number of panels mismatch"
+    assert [panel.index for panel in panels] == list(range(len(panels)))
+    assert panels[0].axis == "Sagittal" and panels[0].mask_index is None
+    assert panels[-1].axis == "Axial" and panels[-1].mask_index == 0
+    assert panels[-1].label == "t2 + seg", "panel label mismatch"
+    assert panels[-1].array.ndim == 3, "panel is not RGB"
+
+    # stopping early should not fail
+    for panel in fig_generator.iter_panels():
+        break
+    print("Passed")
+
+
+def test_thread_budget():
+    import SimpleITK as sitk
+    from concurrent.futures import ThreadPoolExecutor
+    from FigureGenerator.utils import (
+        get_thread_budget,
+        get_threads_per_worker,
+        set_thread_budget,
+        thread_budget_variable,
+    )
+
+    default_threads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    previous_budget = os.environ.pop(thread_budget_variable, None)
+    assert get_thread_budget() is None, "budget should not be configured"
+    os.environ[thread_budget_variable] = "6"
+    assert get_thread_budget() == 6, "budget not read from the environment"
+    assert get_thread_budget(2) == 2, "explicit budget should take precedence"
+
+    assert set_thread_budget(6, 4) == 1, "budget not split across processes"
+    assert sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() == 1
+    assert (
+        os.environ[thread_budget_variable] == "6"
+    ), "budget should not be exported by default"
+    set_thread_budget(6, 2, export=True)
+    assert os.environ[thread_budget_variable] == "3", "budget not exported"
+    os.environ.pop(thread_budget_variable)
+
+    set_thread_budget(4)
+    assert get_threads_per_worker(2) == 2, "threads not split across workers"
+    assert get_threads_per_worker(8) == 1, "workers should get at least one thread"
+
+    args.axisrow = True
+    args.boundtype = "none"
+    args.threads = 2
+    fig_generator = FigureGenerator(args)
+    args.threads = None
+    assert fig_generator.num_threads == 2, "thread budget not set"
+    assert sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() == 2
+    assert thread_budget_variable not in os.environ, "budget leaked to environment"
+    assert fig_generator.get_number_of_workers(24) == 2, "workers exceed budget"
+
+    # concurrent and interleaved panel generation never changes the global
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(4)
+    fig_generator.num_threads = None
+    panels = fig_generator.iter_panels()
+    next(panels)
+    assert sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() == 4
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda _: fig_generator.get_blended_slices(), range(2)))
+    assert len(list(panels)) == 3 * 4 * 2 - 1, "number of panels mismatch"
+    assert sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() == 4
+
+    if previous_budget is not None:
+        os.environ[thread_budget_variable] = previous_budget
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(default_threads)
+    print("Passed")
+
+
+def test_cohort_grid():
+    import contextlib, csv, io, json, shutil
+    import numpy as np
+    from FigureGenerator.cohort_grid import _prepare_subject, generate_cohort_grid
+
+    grid_dir = os.path.join(inputDir, "grid")
+    cohort_file = os.path.join(inputDir, "cohort_grid.csv")
+    images = ",".join(args.images.split(",")[:2])
+    with open(cohort_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["SubjectID", "Images", "Masks", "YLabels"])
+        for subject_id, ylabels in [
+            ("subject_1", "FL,T1C"),
+            ("subject_2", "FL,T1C"),
+            ("subject_3", "T1,T2"),
+        ]:
+            writer.writerow([subject_id, images, args.masks, ylabels])
+        missing_image = os.path.join(inputDir, "missing.nii.gz")
+        writer.writerow(["subject_4", missing_image, "", ""])
+
+    output = os.path.join(grid_dir, "grid.png")
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        grid = generate_cohort_grid(cohort_file, output, page_rows=2, num_workers=2)
+    assert grid["rows"] == 3 and grid["columns"] == 6, "grid size mismatch"
+    assert list(grid["failed"]) == ["subject_4"], "missing subject not skipped"
+    assert "Labels of subject 'subject_3'" in messages.getvalue(), "labels not warned"
+    assert [page["row_labels"] for page in grid["pages"]] == [
+        ["subject_1", "subject_2"],
+        ["subject_3"],
+    ], "subjects not paged"
+    assert grid["pages"][1]["rows"] == [2, 3], "page rows mismatch"
+    assert len(grid["pages"][1]["panels"]) == 6, "page panels mismatch"
+    for page in grid["pages"]:
+        assert os.path.exists(os.path.join(grid_dir, page["file"])), "page missing"
+    assert os.path.exists(os.path.join(grid_dir, "grid_pages.json")), "index missing"
+
+    with open(os.path.join(grid_dir, "grid_pages.json")) as f:
+        assert json.load(f)["rows"] == 3, "index mismatch"
+
+    # large cohorts are paged by default
+    os.remove(os.path.join(grid_dir, "grid_pages.json"))
+    grid = generate_cohort_grid(cohort_file, output, num_workers=2)
+    assert [page["file"] for page in grid["pages"]] == [
+        "grid_page001.png"
+    ], "subjects not paged by default"
+    assert os.path.exists(os.path.join(grid_dir, "grid_pages.json")), "index missing"
+
+    # rows hold the same slices as the single-subject figure
+    args.axisrow = True
+    args.boundtype = "mask"
+    panels = FigureGenerator(args).get_blended_slices([(0, 0, 0), (1, 0, 2)])
+    subject = {"images": images, "masks": args.masks, "ylabels": None}
+    parameters = {
+        "opacity": args.opacity,
+        "borderpc": args.borderpc,
+        "boundtype": args.boundtype,
+        "fontsize": args.fontsize,
+        "flip_sagittal": False,
+        "flip_coronal": False,
+        "flip_axial": False,
+        "summary": None,
+        "low_memory": False,
+    }
+    row = _prepare_subject(subject, parameters)
+    assert np.array_equal(row["panels"][0], panels[0]), "panel mismatch"
+    assert np.array_equal(row["panels"][5], panels[1]), "panel mismatch"
+
+    os.remove(cohort_file)
+    shutil.rmtree(grid_dir)
+    print("Passed")